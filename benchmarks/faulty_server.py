@@ -0,0 +1,205 @@
+import os
+import re
+import time
+import uuid
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Local test server serving generated files with optional fault injection, used
+# by run_benchmarks.py. Files are addressed by size: /data/<bytes>
+# Faults are configured per url through the query string:
+#   latency=<seconds>      delay before every response
+#   bandwidth=<bytes/s>    per connection send rate cap
+#   disconnects=<n>        cut the first n GETs half way through the body
+#   errors=<n>             answer the first n requests (HEAD or GET) with 503
+#   ranges=0               behave like a server without range support
+#   multiranges=0          only honour the first of several requested ranges
+#   head=0                 answer HEAD with 405
+# Counters for disconnects/errors are kept per url, add a unique token (run=...)
+# to get a fresh set.
+
+block_size = 1024*1024
+send_size = 64*1024
+random_block = os.urandom(block_size)
+
+data_cache = {}
+data_lock = threading.Lock()
+
+# A repeated random block keeps memory generation cheap for big sizes while
+# still being incompressible at the chunk level.
+def get_data(size):
+    with data_lock:
+        if size not in data_cache:
+            repeats = size // block_size + 1
+            data_cache[size] = memoryview(random_block * repeats)[:size]
+        return data_cache[size]
+
+counters = {}
+counters_lock = threading.Lock()
+
+# Returns True while the named counter for this url hasn't reached limit yet.
+def take_fault(url, name, limit):
+    if limit <= 0:
+        return False
+    with counters_lock:
+        key = (url, name)
+        count = counters.get(key, 0)
+        if count >= limit:
+            return False
+        counters[key] = count + 1
+        return True
+
+# "bytes=0-99,200-,-50" -> [(0, 99), (200, size-1), (size-50, size-1)], unsatisfiable
+# ranges dropped. None for a missing or malformed header (serve the whole file).
+def parse_ranges(range_header, size):
+    match = re.match(r"^bytes=(.+)$", (range_header or "").strip())
+    if not match:
+        return None
+    ranges = []
+    for spec in match.group(1).split(","):
+        spec_match = re.match(r"^(\d*)-(\d*)$", spec.strip())
+        if not spec_match or not (spec_match.group(1) or spec_match.group(2)):
+            return None
+        if not spec_match.group(1):
+            start, end = max(size - int(spec_match.group(2)), 0), size - 1
+        else:
+            start = int(spec_match.group(1))
+            end = min(int(spec_match.group(2)), size - 1) if spec_match.group(2) else size - 1
+        if start <= end:
+            ranges.append((start, end))
+    return ranges
+
+class FaultyHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, Nagle + delayed ACK would add
+    # ~40ms to every small response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def parse(self):
+        parsed = urlparse(self.path)
+        match = re.match(r"^/data/(\d+)$", parsed.path)
+        if not match:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        options = {
+            "size": int(match.group(1)),
+            "latency": float(query.get("latency", 0)),
+            "bandwidth": float(query.get("bandwidth", 0)),
+            "disconnects": int(query.get("disconnects", 0)),
+            "errors": int(query.get("errors", 0)),
+            "ranges": query.get("ranges", "1") != "0",
+            "multiranges": query.get("multiranges", "1") != "0",
+            "head": query.get("head", "1") != "0",
+        }
+
+        if options["latency"]:
+            time.sleep(options["latency"])
+
+        if take_fault(self.path, "errors", options["errors"]):
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+
+        return options
+
+    def do_HEAD(self):
+        options = self.parse()
+        if not options:
+            return
+        if not options["head"]:
+            self.send_response(405)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(options["size"]))
+        if options["ranges"]:
+            self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        options = self.parse()
+        if not options:
+            return
+
+        size = options["size"]
+        ranges = parse_ranges(self.headers.get("Range"), size) if options["ranges"] else None
+        if ranges == []:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        data = get_data(size)
+        if ranges and len(ranges) > 1 and options["multiranges"]:
+            boundary = uuid.uuid4().hex
+            pieces = []
+            for start, end in ranges:
+                pieces.append((f"\r\n--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+                               f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode())
+                pieces.append(data[start:end + 1])
+            pieces.append(f"\r\n--{boundary}--\r\n".encode())
+            self.send_response(206)
+            self.send_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+        elif ranges:
+            start, end = ranges[0]
+            pieces = [data[start:end + 1]]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            pieces = [data]
+            self.send_response(200)
+            if options["ranges"]:
+                self.send_header("Accept-Ranges", "bytes")
+
+        length = sum(len(piece) for piece in pieces)
+        self.send_header("Content-Length", str(length))
+        self.end_headers()
+
+        limit = length
+        if take_fault(self.path, "disconnects", options["disconnects"]):
+            limit = length // 2
+            self.close_connection = True
+
+        sent = 0
+        started = time.perf_counter()
+        try:
+            for piece in pieces:
+                position = 0
+                while position < len(piece) and sent < limit:
+                    part = piece[position:position + min(send_size, limit - sent)]
+                    self.wfile.write(part)
+                    position += len(part)
+                    sent += len(part)
+                    if options["bandwidth"]:
+                        ahead = sent / options["bandwidth"] - (time.perf_counter() - started)
+                        if ahead > 0:
+                            time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+def serve(host="localhost", port=6100):
+    server = ThreadingHTTPServer((host, port), FaultyHandler)
+    server.daemon_threads = True
+    logger.info(f"Faulty server started http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    serve()
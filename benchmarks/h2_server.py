@@ -0,0 +1,164 @@
+import re
+import time
+import socket
+import threading
+import socketserver
+from urllib.parse import urlparse, parse_qs
+
+import h2.config
+import h2.events
+import h2.errors
+import h2.exceptions
+import h2.connection
+
+from benchmarks.faulty_server import FaultyHandler, get_data, parse_ranges
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Local HTTP/2 (prior knowledge, h2c) test server for the same /data/<bytes> files as
+# faulty_server.py, used to compare transports. HTTP/1.1 connections on the same port
+# are handed to FaultyHandler so both protocols share a server. Supported options:
+#   latency=<seconds>      delay before every response, streams wait concurrently
+#   ranges=0               behave like a server without range support
+# Every stream is answered from its own thread, multiplexed over the connection.
+
+preface = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+class H2Connection():
+    def __init__(self, sock):
+        self.sock = sock
+        config = h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        self.connection = h2.connection.H2Connection(config=config)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.reset_streams = set()
+
+    def flush(self):
+        data = self.connection.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def run(self):
+        with self.condition:
+            self.connection.initiate_connection()
+            self.flush()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                with self.condition:
+                    events = self.connection.receive_data(data)
+                    for event in events:
+                        if isinstance(event, h2.events.RequestReceived):
+                            threading.Thread(target=self.respond, args=(event.stream_id, dict(event.headers)),
+                                             daemon=True).start()
+                        elif isinstance(event, h2.events.StreamReset):
+                            self.reset_streams.add(event.stream_id)
+                        elif isinstance(event, h2.events.ConnectionTerminated):
+                            self.closed = True
+                    self.flush()
+                    self.condition.notify_all()
+                if self.closed:
+                    break
+        except h2.exceptions.ProtocolError as ex:
+            # As a real server would: GOAWAY and hang up, the client retries
+            logger.debug(f"Protocol error, closing connection: {ex}")
+            with self.condition:
+                try:
+                    self.connection.close_connection(h2.errors.ErrorCodes.PROTOCOL_ERROR)
+                    self.flush()
+                except OSError:
+                    pass
+        except (ConnectionResetError, BrokenPipeError, OSError):
+            pass
+        finally:
+            with self.condition:
+                self.closed = True
+                self.condition.notify_all()
+
+    def respond(self, stream_id, headers):
+        try:
+            self.send_response(stream_id, headers)
+        except Exception as ex:
+            logger.debug(f"Stream {stream_id} failed: {ex}")
+
+    def send_headers(self, stream_id, status, headers, end_stream):
+        with self.condition:
+            self.connection.send_headers(stream_id, [(":status", str(status))] + headers, end_stream=end_stream)
+            self.flush()
+
+    def send_response(self, stream_id, headers):
+        parsed = urlparse(headers[":path"])
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        match = re.match(r"^/data/(\d+)$", parsed.path)
+        if not match:
+            return self.send_headers(stream_id, 404, [("content-length", "0")], True)
+        if float(query.get("latency", 0)):
+            time.sleep(float(query["latency"]))
+
+        size = int(match.group(1))
+        range_support = query.get("ranges", "1") != "0"
+        if headers[":method"] == "HEAD":
+            response_headers = [("content-length", str(size))]
+            if range_support:
+                response_headers.append(("accept-ranges", "bytes"))
+            return self.send_headers(stream_id, 200, response_headers, True)
+
+        ranges = parse_ranges(headers.get("range"), size) if range_support else None
+        if ranges == []:
+            return self.send_headers(stream_id, 416, [("content-range", f"bytes */{size}"),
+                                                      ("content-length", "0")], True)
+        if ranges:
+            start, end = ranges[0]
+            status = 206
+            response_headers = [("content-range", f"bytes {start}-{end}/{size}")]
+        else:
+            start, end = 0, size - 1
+            status = 200
+            response_headers = [("accept-ranges", "bytes")] if range_support else []
+        body = get_data(size)[start:end + 1]
+        response_headers.append(("content-length", str(len(body))))
+        self.send_headers(stream_id, status, response_headers, not len(body))
+
+        # Send as fast as flow control allows
+        sent = 0
+        while sent < len(body):
+            with self.condition:
+                if self.closed or stream_id in self.reset_streams:
+                    return
+                window = min(self.connection.local_flow_control_window(stream_id),
+                             self.connection.max_outbound_frame_size, len(body) - sent)
+                if window <= 0:
+                    self.condition.wait(1)
+                    continue
+                self.connection.send_data(stream_id, bytes(body[sent:sent + window]),
+                                          end_stream=(sent + window == len(body)))
+                sent += window
+                self.flush()
+
+class DualProtocolHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        start = self.request.recv(len(preface), socket.MSG_PEEK)
+        if start == preface[:len(start)] and start:
+            H2Connection(self.request).run()
+        else:
+            FaultyHandler(self.request, self.client_address, self.server)
+
+class DualProtocolServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def serve(host="localhost", port=6101):
+    server = DualProtocolServer((host, port), DualProtocolHandler)
+    logger.info(f"h2 server started http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    serve()
@@ -0,0 +1,314 @@
+import os
+import sys
+import json
+import time
+import uuid
+import pickle
+import shutil
+import argparse
+import platform
+import tempfile
+from queue import Empty
+from multiprocessing import Process, Queue
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import resource
+except ImportError: # Windows
+    resource = None
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import best_download
+from best_download import download_file, set_connection_pool_size, fetch_ranges, set_transport
+from benchmarks.faulty_server import serve
+
+try:
+    from benchmarks import h2_server
+except ImportError: # h2 not installed, no transport comparison
+    h2_server = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Runs download_file against a local faulty_server and writes comparable json results.
+#   python benchmarks/run_benchmarks.py --output baseline.json
+#   python benchmarks/run_benchmarks.py --compare baseline.json
+# Every case runs in a fresh process so CPU time and peak RSS belong to that case alone.
+
+mb = 1000*1000
+
+def get_usage():
+    if resource:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        peak_rss = usage.ru_maxrss # KiB on Linux
+        if sys.platform == "darwin":
+            peak_rss /= 1024 # bytes on macOS
+        return usage.ru_utime + usage.ru_stime, peak_rss
+    return time.process_time(), None
+
+def case_url(server, size, **faults):
+    # Unique run token gives every case fresh fault counters on the server
+    faults["run"] = uuid.uuid4().hex
+    query = "&".join(f"{key}={value}" for key, value in faults.items())
+    return f"{server}/data/{size}?{query}"
+
+# Leaves half a file plus checkpoint behind, as if a previous download was interrupted.
+def prepare_partial(url, local_file, size):
+    half = size // 2
+    with requests.get(url, headers={"Range": f"bytes=0-{half - 1}"}) as response:
+        response.raise_for_status()
+        with open(local_file, "wb") as fh:
+            fh.write(response.content)
+    pickle.dump(half, open(local_file + ".ckpnt", "wb"))
+    return size - half
+
+def run_case(case, servers, work_directory, results):
+    # Keep tqdm bars and per download logging out of the way
+    sys.stderr = open(os.devnull, "w")
+    logging.getLogger("best_download").setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    server = servers[case.get("server", "faulty")]
+    if case.get("transport") == "http2":
+        set_transport("http2", prior_knowledge=True)
+
+    size = case["size"]
+    concurrency = case.get("concurrency", 1)
+    files = case.get("files", 1)
+    download_args = case.get("download_args", {})
+    faults = case.get("faults", {})
+    urls = [case_url(server, size, **faults) for _ in range(concurrency * files)]
+    local_files = [os.path.join(work_directory, f"{case['name']}.{i}") for i in range(concurrency * files)]
+    if concurrency > 10:
+        set_connection_pool_size(concurrency)
+
+    transferred = size * concurrency * files
+    if case.get("resume"):
+        transferred = prepare_partial(urls[0], local_files[0], size)
+
+    # Scattered small reads from one file, files counts the ranges
+    if case.get("ranges"):
+        transferred = case["ranges"] * case["range_size"]
+        step = size // case["ranges"]
+        ranges = [(i * step, case["range_size"]) for i in range(case["ranges"])]
+        local_files = [None] * case["ranges"]
+
+    cpu_before, _ = get_usage()
+    start = time.perf_counter()
+    if case.get("ranges"):
+        success = fetch_ranges(urls[0], ranges, **download_args) is not None
+    elif concurrency == 1:
+        success = all([download_file(url, local_file=local_file, **download_args)
+                       for url, local_file in zip(urls, local_files)])
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            success = all(executor.map(lambda args: download_file(args[0], local_file=args[1], **download_args),
+                                       zip(urls, local_files)))
+    seconds = time.perf_counter() - start
+    cpu_after, peak_rss = get_usage()
+
+    cpu_seconds = cpu_after - cpu_before
+    results.put({
+        "success": bool(success) and all(path is None or (os.path.exists(path) and os.path.getsize(path) == size)
+                                         for path in local_files),
+        "size": size,
+        "concurrency": concurrency,
+        "files": len(local_files),
+        "faults": faults,
+        "seconds": round(seconds, 4),
+        "mb_per_second": round(transferred / mb / seconds, 2),
+        "cpu_seconds": round(cpu_seconds, 4),
+        "cpu_seconds_per_gb": round(cpu_seconds / (transferred / 1e9), 3),
+        "peak_rss_mb": round(peak_rss / 1024, 1) if peak_rss else None,
+        "ms_per_file": round(seconds / len(local_files) * 1000, 2),
+    })
+
+def get_cases(sizes, concurrency_levels):
+    cases = []
+    for size in sizes:
+        cases.append({"name": f"resumable_{size // mb}mb", "size": size})
+        cases.append({"name": f"full_{size // mb}mb", "size": size, "faults": {"ranges": 0}})
+        cases.append({"name": f"resume_{size // mb}mb", "size": size, "resume": True})
+
+    medium = sizes[len(sizes) // 2]
+    for concurrency in concurrency_levels:
+        cases.append({"name": f"concurrent_{concurrency}x{medium // mb}mb", "size": medium,
+                      "concurrency": concurrency})
+
+    cases.append({"name": f"latency_{medium // mb}mb", "size": medium, "faults": {"latency": 0.05}})
+    cases.append({"name": f"throttled_{medium // mb}mb", "size": medium, "faults": {"bandwidth": 50*mb}})
+    cases.append({"name": f"disconnect_{medium // mb}mb", "size": medium, "faults": {"disconnects": 1}})
+    cases.append({"name": f"5xx_burst_{medium // mb}mb", "size": medium, "faults": {"errors": 2}})
+
+    # Per file latency for many small files, HEAD + GET vs a single ranged GET.
+    # The server side latency stands in for a network round trip.
+    for use_head in [True, False]:
+        cases.append({"name": f"small_files_{'head' if use_head else 'probe'}", "size": 16*1024, "files": 50,
+                      "faults": {"latency": 0.005}, "download_args": {"use_head": use_head}})
+
+    # Many small files at high concurrency over the same local server, HTTP/1.1 with
+    # a connection per worker vs HTTP/2 streams multiplexed over a few connections
+    if h2_server:
+        for transport in ["http1", "http2"]:
+            cases.append({"name": f"transport_{transport}_small_files", "size": 16*1024, "files": 8,
+                          "concurrency": 32, "server": "h2", "transport": transport,
+                          "faults": {"latency": 0.005}, "download_args": {"use_head": False}})
+            cases.append({"name": f"transport_{transport}_{medium // mb}mb", "size": medium, "server": "h2",
+                          "transport": transport})
+
+    # 200 scattered 4KB reads, coalesced multi-range requests vs a server that only
+    # honours single ranges (pooled single-range requests)
+    for multiranges in [1, 0]:
+        cases.append({"name": f"ranges_{'multi' if multiranges else 'single'}", "size": medium, "ranges": 200,
+                      "range_size": 4096, "faults": {"latency": 0.005, "multiranges": multiranges}})
+    return cases
+
+# Checkpoint overhead: resumable (checkpoint per chunk) vs full download of the same size.
+def add_derived(results):
+    for name, result in list(results.items()):
+        if not name.startswith("resumable_"):
+            continue
+        suffix = name[len("resumable_"):]
+        full = results.get(f"full_{suffix}")
+        if full and "seconds" in full and "seconds" in result:
+            result["checkpoint_overhead"] = round(result["seconds"] / full["seconds"] - 1, 3)
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    print(f"{'case':<28}{'MB/s':>10}{'base':>10}{'cpu s/GB':>10}{'base':>10}{'ms/file':>10}{'base':>10}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or "mb_per_second" not in base:
+            continue
+        if "mb_per_second" not in result:
+            print(f"{name:<28}{'crashed':>10}")
+            regressions.append(f"{name}: crashed")
+            continue
+        print(f"{name:<28}{result['mb_per_second']:>10}{base['mb_per_second']:>10}"
+              f"{result['cpu_seconds_per_gb']:>10}{base['cpu_seconds_per_gb']:>10}"
+              f"{result['ms_per_file']:>10}{base.get('ms_per_file', '-'):>10}")
+        if result["mb_per_second"] < base["mb_per_second"] * (1 - tolerance):
+            regressions.append(f"{name}: MB/s {base['mb_per_second']} -> {result['mb_per_second']}")
+        if result["cpu_seconds_per_gb"] > base["cpu_seconds_per_gb"] * (1 + tolerance):
+            regressions.append(f"{name}: cpu s/GB {base['cpu_seconds_per_gb']} -> {result['cpu_seconds_per_gb']}")
+    return regressions
+
+# The case's result, or None if its process died without sending one.
+def get_result(queue, case_process):
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if not case_process.is_alive():
+                try:
+                    return queue.get(timeout=1) # Sent just before exiting
+                except Empty:
+                    return None
+
+def wait_for_server(server):
+    for _ in range(50):
+        try:
+            requests.head(f"{server}/data/1", timeout=1)
+            return
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+    raise RuntimeError(f"Benchmark server {server} didn't start")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark download_file against a local faulty server.")
+    parser.add_argument("--sizes", default="1,16,128", help="File sizes in MB (default: 1,16,128).")
+    parser.add_argument("--concurrency", default="1,4,8", help="Concurrency levels (default: 1,4,8).")
+    parser.add_argument("--cases", help="Only run cases whose name contains one of these comma separated strings.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case, the median is kept (default: 3).")
+    parser.add_argument("--port", type=int, default=6100,
+                        help="Benchmark server port, the HTTP/2 server uses the next one (default: 6100).")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="Baseline json to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="Allowed relative regression before failing (default: 0.15).")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    sizes = [int(float(size) * mb) for size in args.sizes.split(",")]
+    concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    cases = get_cases(sizes, concurrency_levels)
+    if args.cases:
+        filters = args.cases.split(",")
+        cases = [case for case in cases if any(name in case["name"] for name in filters)]
+
+    servers = {"faulty": f"http://localhost:{args.port}"}
+    server_processes = [Process(target=serve, args=("localhost", args.port), daemon=True)]
+    if h2_server:
+        servers["h2"] = f"http://localhost:{args.port + 1}"
+        server_processes.append(Process(target=h2_server.serve, args=("localhost", args.port + 1), daemon=True))
+    for server_process in server_processes:
+        server_process.start()
+    work_directory = tempfile.mkdtemp(prefix="best_download_bench_")
+    results = {}
+    try:
+        for server in servers.values():
+            wait_for_server(server)
+        for case in cases:
+            runs = []
+            for _ in range(args.repeat):
+                queue = Queue()
+                case_process = Process(target=run_case, args=(case, servers, work_directory, queue))
+                case_process.start()
+                runs.append(get_result(queue, case_process))
+                case_process.join()
+                for name in os.listdir(work_directory):
+                    os.remove(os.path.join(work_directory, name))
+
+            if None in runs:
+                results[case["name"]] = {"success": False, "exitcode": case_process.exitcode}
+                logger.info(f"{case['name']:<28} CRASHED (exit code {case_process.exitcode})")
+                continue
+
+            # Median run by wall time smooths out scheduler noise
+            runs.sort(key=lambda run: run["seconds"])
+            result = runs[len(runs) // 2]
+            result["success"] = all(run["success"] for run in runs)
+            result["repeats"] = len(runs)
+            results[case["name"]] = result
+            logger.info(f"{case['name']:<28} {result['mb_per_second']:>8} MB/s {result['ms_per_file']:>8} ms/file "
+                         f"{result['cpu_seconds_per_gb']:>8} cpu s/GB {result['peak_rss_mb']} MB rss"
+                         f"{'' if result['success'] else ' FAILED'}")
+    finally:
+        for server_process in server_processes:
+            server_process.terminate()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    add_derived(results)
+    output = {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "chunk_size": best_download.chunk_size,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as fh:
+        json.dump(output, fh, indent=2)
+    logger.info(f"Results written to {args.output}")
+
+    failed = [name for name, result in results.items() if not result["success"]]
+    if failed:
+        logger.info(f"Failed cases: {', '.join(failed)}")
+
+    if args.compare:
+        with open(args.compare, "r") as fh:
+            baseline = json.load(fh)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            logger.info(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
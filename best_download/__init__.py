@@ -6,31 +6,121 @@ import os
 from pathlib import Path
 from urllib.parse import urlparse
 import time
-import hashlib
 import math
+import re
+import threading
+from email.utils import parsedate_to_datetime
 
 import requests
 from requests.adapters import HTTPAdapter
 from requests.packages.urllib3.util.retry import Retry
 from tqdm import tqdm
 
+from best_download.checksums import MultiHasher, parse_expected_checksum, get_algorithms, get_mismatches, \
+                                    hash_file
+from best_download.transports import RequestsTransport, HTTP2Transport
+
 import logging
 logger = logging.getLogger(__name__)
 
-# Head request to get file-length and check whether it supports ranges.
-def get_file_info_from_server(url):
+# Successful metadata lookups are cached per url for this many seconds so batch
+# runs (mirror_directory etc) don't repeat HEAD requests. Set to 0 to disable.
+metadata_cache_ttl = 30
+metadata_cache = {}
+metadata_cache_lock = threading.Lock()
+
+def cache_metadata(url, metadata):
+    if metadata_cache_ttl <= 0:
+        return
+    now = time.monotonic()
+    with metadata_cache_lock:
+        if len(metadata_cache) > 10000:
+            for key in [key for key, (expiry, _) in metadata_cache.items() if expiry <= now]:
+                del metadata_cache[key]
+        metadata_cache[url] = (now + metadata_cache_ttl, metadata)
+
+def get_cached_metadata(url):
+    with metadata_cache_lock:
+        cached = metadata_cache.get(url)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    return None
+
+# Size, range support and validators (ETag, Last-Modified) from response headers.
+def parse_metadata(headers):
+    content_length = None
+    if "Content-Length" in headers:
+        content_length = int(headers['Content-Length'])
+    last_modified = None
+    if "Last-Modified" in headers:
+        try:
+            last_modified = parsedate_to_datetime(headers["Last-Modified"]).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return {
+        "accept_ranges": (headers.get("Accept-Ranges") == "bytes"),
+        "content_length": content_length,
+        "etag": headers.get("ETag"),
+        "last_modified": last_modified,
+    }
+
+# "bytes 100-199/1000" -> (100, 1000). Total is None when the server sends "*".
+def parse_content_range(content_range):
+    match = re.match(r"^bytes (\d+)-(\d+)/(\d+|\*)$", (content_range or "").strip())
+    if not match:
+        return None
+    total = None if match.group(3) == "*" else int(match.group(3))
+    return int(match.group(1)), total
+
+# Head request (through the transport) to get file-length, range support and
+# validators. Returns None if the HEAD request fails. use_cache=False forces a fresh
+# request (the result still refreshes the cache).
+def get_file_metadata(url, use_cache=True):
+    metadata = get_cached_metadata(url) if use_cache else None
+    if metadata:
+        return metadata
     try:
         headers={"Accept-Encoding": "identity"} # Avoid dealing with gzip
-        response = requests.head(url, headers=headers) 
+        response = transport.head(url, headers=headers, timeout=5)
         response.raise_for_status()
-        content_length = None
-        if "Content-Length" in response.headers:
-            content_length = int(response.headers['Content-Length'])
-        accept_ranges = (response.headers.get("Accept-Ranges") == "bytes")
-        return accept_ranges, content_length
+        metadata = parse_metadata(response.headers)
+        cache_metadata(url, metadata)
+        return metadata
     except Exception as ex:
         logger.info(f"HEAD Request Error: {ex}")
+        return None
+
+# get_file_metadata for servers rejecting HEAD, from a one byte ranged GET. A 206
+# gives the size in Content-Range, a 200 (ranges ignored) in Content-Length without
+# its body being read. Returns None on failure.
+def probe_file_metadata(url):
+    try:
+        headers = {"Accept-Encoding": "identity", "Range": "bytes=0-0"}
+        with transport.get(url, headers=headers, timeout=5) as response:
+            metadata = parse_metadata(response.headers)
+            content_range = response.headers.get("Content-Range", "").strip()
+            if response.status_code == 416 and content_range == "bytes */0": # Empty file
+                metadata["content_length"] = 0
+                return metadata
+            response.raise_for_status()
+            if response.status_code == 206:
+                content_range = parse_content_range(content_range)
+                if not content_range:
+                    return None
+                metadata["accept_ranges"] = True
+                metadata["content_length"] = content_range[1]
+            cache_metadata(url, metadata)
+            return metadata
+    except Exception as ex:
+        logger.info(f"Probe request failed: {ex}")
+        return None
+
+# Head request to get file-length and check whether it supports ranges.
+def get_file_info_from_server(url, use_cache=True):
+    metadata = get_file_metadata(url, use_cache)
+    if not metadata:
         return False, None
+    return metadata["accept_ranges"], metadata["content_length"]
 
 # Support 3 retries and backoff
 retry_strategy = Retry(
@@ -44,22 +134,77 @@ session = requests.Session()
 session.mount("https://", adapter)
 session.mount("http://", adapter)
 
+# HEAD is only a hint (downloads fall back to a plain GET without it), so no retries:
+# servers rejecting HEAD with 503 would otherwise cost the full backoff on every file.
+head_adapter = HTTPAdapter(max_retries=0)
+head_session = requests.Session()
+head_session.mount("https://", head_adapter)
+head_session.mount("http://", head_adapter)
+
+# The default pool keeps 10 connections per host, raise this when downloading with
+# more threads than that so connections are reused rather than discarded.
+def set_connection_pool_size(pool_size):
+    global adapter, head_adapter
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_connections=pool_size,
+                          pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    head_adapter = HTTPAdapter(max_retries=0, pool_connections=pool_size, pool_maxsize=pool_size)
+    head_session.mount("https://", head_adapter)
+    head_session.mount("http://", head_adapter)
+
+# HEAD and GET requests for downloads go through this, HTTP/1.1 over session by default.
+transport = RequestsTransport(session, head_session)
+
+# "http1" (requests, the default), "http2" (httpx, kwargs go to HTTP2Transport) or any
+# object with the same head/get methods, see transports.py. The previous HTTP/2
+# transport's connections are closed.
+def set_transport(new_transport, **kwargs):
+    global transport
+    if isinstance(transport, HTTP2Transport) and transport is not new_transport:
+        transport.close()
+    if new_transport == "http1":
+        transport = RequestsTransport(session, head_session)
+    elif new_transport == "http2":
+        transport = HTTP2Transport(**kwargs)
+    else:
+        transport = new_transport
+
 chunk_size = 1024*1024
 
-def download_file_full(url, local_file, content_length):
+# SIGINT only reaches the main thread, downloads running in other threads check this
+# every chunk and stop as if interrupted (KeyboardInterrupt, checkpoint kept). Bulk
+# downloaders (cli, mirror_directory) set it on CTRL-C and clear it once their workers
+# have stopped. cancel_event does the same for a single download_file call
+# (Prefetcher.close).
+stop_event = threading.Event()
+
+def stop_requested(cancel_event):
+    return stop_event.is_set() or (cancel_event is not None and cancel_event.is_set())
+
+# Writes the whole of response to file_out, returns the digests.
+def stream_full(response, file_out, content_length, algorithms, cancel_event=None):
+    checksum = MultiHasher(algorithms or ["sha256"])
+    with tqdm(total=content_length, unit="byte", unit_scale=1) as progress:
+        for chunk in response.iter_content(chunk_size):
+            if stop_requested(cancel_event):
+                raise KeyboardInterrupt
+            file_out.write(chunk)
+            checksum.update(chunk)
+            progress.update(len(chunk))
+
+    return checksum.hexdigests()
+
+# Download methods return a dict of {algorithm: hex digest} for algorithms
+# (default sha256) or None on failure.
+def download_file_full(url, local_file, content_length, algorithms=None, cancel_event=None):
     try:
-        checksum = hashlib.sha256()
         headers = {"Accept-Encoding": "identity"} # Avoid dealing with gzip
-        with tqdm(total=content_length, unit="byte", unit_scale=1) as progress, \
-             session.get(url, headers=headers, stream=True, timeout=5) as response, \
+        with transport.get(url, headers=headers, timeout=5) as response, \
              open(local_file, 'wb') as file_out:
 
             response.raise_for_status()
-
-            for chunk in response.iter_content(chunk_size):
-                file_out.write(chunk)
-                checksum.update(chunk)
-                progress.update(len(chunk))
+            return stream_full(response, file_out, content_length, algorithms, cancel_event)
 
     except KeyboardInterrupt as ex:
         raise ex
@@ -67,27 +212,26 @@ def download_file_full(url, local_file, content_length):
         logger.info(f"Download error: {ex}")
         return None
 
-    return checksum.hexdigest()
-
 class SigintHandler():
     def __init__(self):
         self.terminate = False
-        handler_wrapper = lambda x,y: self.handler(x,y)
-        self.previous_signal_int = signal.signal(SIGINT, handler_wrapper)
+        # Signal handlers can only be installed from the main thread, worker threads
+        # (mirror_directory etc) leave SIGINT to the main thread.
+        self.installed = (threading.current_thread() is threading.main_thread())
+        if self.installed:
+            handler_wrapper = lambda x,y: self.handler(x,y)
+            self.previous_signal_int = signal.signal(SIGINT, handler_wrapper)
 
     def handler(self, signal_received, frame):
         self.terminate = True
 
     def release(self):
-        signal.signal(SIGINT, self.previous_signal_int)
-
-def download_file_resumable(url, local_file, content_length):
-    pass
+        if self.installed:
+            signal.signal(SIGINT, self.previous_signal_int)
 
-    # Handle sigint manually to avoid checkpoint corruption
-    sigint_handler = SigintHandler() 
-
-    # Always go off the checkpoint as the file was flushed before writing.
+# Always go off the checkpoint as the file was flushed before writing.
+# Returns the resume point, starting local_file afresh if there's no usable checkpoint.
+def load_checkpoint(local_file):
     download_checkpoint = local_file + ".ckpnt"
     try:
         resume_point = pickle.load(open(download_checkpoint, "rb"))   
@@ -98,8 +242,58 @@ def download_file_resumable(url, local_file, content_length):
         if os.path.exists(local_file):
             os.remove(local_file)
         Path(local_file).touch()
+    return resume_point
 
-    assert (resume_point < content_length)
+# Hashes the existing prefix of local_file then appends response from resume_point,
+# checkpointing every chunk. Returns the digests, or None if the file is short.
+def stream_resumable(response, local_file, resume_point, content_length, algorithms, sigint_handler,
+                     cancel_event=None):
+    download_checkpoint = local_file + ".ckpnt"
+    with tqdm(total=content_length, unit="byte", unit_scale=1) as progress, \
+         open(local_file, 'r+b') as file_out:
+
+        checksum = MultiHasher(algorithms or ["sha256"])
+        file_out.seek(0)
+        for _ in range(math.ceil(resume_point / chunk_size)):
+            checksum.update(file_out.read(chunk_size))
+
+        progress.update(resume_point)
+        file_out.seek(resume_point)
+
+        for chunk in response.iter_content(chunk_size):                
+            if sigint_handler.terminate or stop_requested(cancel_event):
+                raise KeyboardInterrupt
+
+            file_out.write(chunk)
+            file_out.flush()
+            resume_point += len(chunk)
+            checksum.update(chunk)                        
+            pickle.dump(resume_point, open(download_checkpoint,"wb"))
+            progress.update(len(chunk))
+
+    # Only remove checkpoint at full size in case connection cut
+    if os.path.getsize(local_file) == content_length:
+        os.remove(download_checkpoint)
+    else:
+        return None
+
+    return checksum.hexdigests()
+
+def download_file_resumable(url, local_file, content_length, algorithms=None, cancel_event=None):
+    pass
+
+    resume_point = load_checkpoint(local_file)
+    if resume_point >= content_length:
+        os.remove(local_file + ".ckpnt")
+        # Cut after the last chunk, or the remote changed size since the checkpoint
+        if resume_point == content_length:
+            logger.info("Checkpoint covers the whole file, finishing.")
+            return hash_file(local_file, algorithms or ["sha256"])
+        logger.info("Checkpoint past the end of the remote file, restarting.")
+        resume_point = load_checkpoint(local_file)
+
+    # Handle sigint manually to avoid checkpoint corruption
+    sigint_handler = SigintHandler() 
 
     # Support resuming
     headers = {}
@@ -107,37 +301,66 @@ def download_file_resumable(url, local_file, content_length):
     headers["Accept-Encoding"] = "identity" # Avoid dealing with gzip
 
     try:
-        with tqdm(total=content_length, unit="byte", unit_scale=1) as progress, \
-             session.get(url, headers=headers, stream=True, timeout=5) as response, \
-             open(local_file, 'r+b') as file_out:
-
+        with transport.get(url, headers=headers, timeout=5) as response:
             response.raise_for_status()
+            return stream_resumable(response, local_file, resume_point, content_length, algorithms,
+                                    sigint_handler, cancel_event)
 
-            checksum = hashlib.sha256()
-            file_out.seek(0)
-            for _ in range(math.ceil(resume_point / chunk_size)):
-                checksum.update(file_out.read(chunk_size))
+    except KeyboardInterrupt as ex:
+        raise ex
+    except Exception as ex:
+        logger.info(f"Download error: {ex}")
+        return None
+    finally:
+        sigint_handler.release()
 
-            progress.update(resume_point)
-            file_out.seek(resume_point)
+# Skips the HEAD request: the first GET asks for "Range: bytes=<resume point>-" and
+# the response tells us everything. A 206 with Content-Range gives the size and
+# range support and is streamed straight into the resumable path, a plain 200 means
+# no range support and is streamed as a full download. content_length is ignored.
+def download_file_probed(url, local_file, content_length=None, algorithms=None, cancel_event=None):
+    sigint_handler = SigintHandler() 
 
-            for chunk in response.iter_content(chunk_size):                
-                if sigint_handler.terminate: 
-                    raise KeyboardInterrupt
+    resume_point = load_checkpoint(local_file)
+    headers = {}
+    headers["Range"] = f"bytes={resume_point}-"
+    headers["Accept-Encoding"] = "identity" # Avoid dealing with gzip
 
-                file_out.write(chunk)
-                file_out.flush()
-                resume_point += len(chunk)
-                checksum.update(chunk)                        
-                pickle.dump(resume_point, open(download_checkpoint,"wb"))
-                progress.update(len(chunk))
+    try:
+        with transport.get(url, headers=headers, timeout=5) as response:
+            # Empty files can't satisfy any range
+            if response.status_code == 416 and resume_point == 0:
+                response.close()
+                return download_file_full(url, local_file, None, algorithms, cancel_event)
+            # Checkpoint already at full size (cut after the last chunk), just hash it
+            if response.status_code == 416 and \
+               response.headers.get("Content-Range", "").strip() == f"bytes */{resume_point}":
+                logger.info("Checkpoint covers the whole file, finishing.")
+                os.remove(local_file + ".ckpnt")
+                return hash_file(local_file, algorithms or ["sha256"])
+            response.raise_for_status()
 
-            # Only remove checkpoint at full size in case connection cut
-            if os.path.getsize(local_file) == content_length:
-                os.remove(download_checkpoint)
-            else:
+            metadata = parse_metadata(response.headers)
+            content_range = parse_content_range(response.headers.get("Content-Range"))
+            if content_range and content_range[0] == resume_point and content_range[1]:
+                logger.info(f"Server supports resume. content length: {content_range[1]}")
+                metadata["accept_ranges"] = True
+                metadata["content_length"] = content_range[1]
+                cache_metadata(url, metadata)
+                return stream_resumable(response, local_file, resume_point, content_range[1], algorithms,
+                                        sigint_handler, cancel_event)
+
+            if os.path.exists(local_file + ".ckpnt"):
+                os.remove(local_file + ".ckpnt")
+            if content_range:
+                logger.info(f"Unexpected Content-Range {response.headers['Content-Range']}, restarting.")
                 return None
 
+            logger.info(f"Server doesn't support resume. content length: {metadata['content_length']}")
+            cache_metadata(url, metadata)
+            with open(local_file, 'wb') as file_out:
+                return stream_full(response, file_out, metadata["content_length"], algorithms, cancel_event)
+
     except KeyboardInterrupt as ex:
         raise ex
     except Exception as ex:
@@ -146,55 +369,78 @@ def download_file_resumable(url, local_file, content_length):
     finally:
         sigint_handler.release()
 
-    return checksum.hexdigest()
+# local_file defaults to the url basepath, local_directory is prepended if provided.
+def get_local_file(url, local_file=None, local_directory=None):
+    if not local_file:
+        local_file = os.path.basename(urlparse(url).path)
+    if local_directory:
+        local_file = os.path.join(local_directory, local_file)
+    return local_file
+
+# Picks the download method for url from its HEAD metadata (probing without HEAD).
+# Returns (method, content_length).
+def get_download_method(url, use_head, use_cache=True):
+    if not use_head:
+        return download_file_probed, None
+
+    accept_ranges, content_length = get_file_info_from_server(url, use_cache)
+    logger.info(f"Accept-Ranges: {accept_ranges}. content length: {content_length}")
+    if accept_ranges and content_length:
+        logger.info("Server supports resume")
+        return download_file_resumable, content_length
+    logger.info(f"Server doesn't support resume.")
+    return download_file_full, content_length
 
 # In order to avoid leaving extra garbage meta files behind this will 
 # will overwrite any existing files found at local_file. If you don't want this
 # behaviour you can handle this externally.
 # local_file and local_directory could write to unexpected places if the source 
 # is untrusted, be careful!
+# expected_checksum is a sha256 hex digest, an algorithm-tagged digest ("md5:...")
+# or a dict of {algorithm: digest}. All requested digests plus any hash_algorithms
+# are computed in the same pass. Returns True/False, or with return_checksums the
+# dict of computed digests on success and None on failure.
+# use_head=False skips the HEAD request, see download_file_probed.
+# Setting cancel_event (a threading.Event) stops this call like CTRL-C: the
+# checkpoint is kept and KeyboardInterrupt raised.
 def download_file(urls, expected_checksum=None, local_file=None, local_directory=None, 
-                  max_retries=3):
+                  max_retries=3, hash_algorithms=None, return_checksums=False, use_head=True,
+                  cancel_event=None):
 
     if not isinstance(urls, list):
         urls = [urls]
 
+    expected_checksums = parse_expected_checksum(expected_checksum)
+    algorithms = get_algorithms(expected_checksums, hash_algorithms)
+
     success = False
     try:
         for url in urls:
             # Need to rebuild local_file_final each time in case of different urls
-            if not local_file:        
-                specific_local_file = os.path.basename(urlparse(url).path)
-            else:
-                specific_local_file = local_file
-
+            specific_local_file = get_local_file(url, local_file, local_directory)
             if local_directory:
                 os.makedirs(local_directory, exist_ok=True)
-                specific_local_file = os.path.join(local_directory, specific_local_file)
 
-            accept_ranges, content_length = get_file_info_from_server(url)
-            logger.info(f"Accept-Ranges: {accept_ranges}. content length: {content_length}")
-            if accept_ranges and content_length:
-                download_method = download_file_resumable
-                logger.info("Server supports resume")
-            else:
-                download_method = download_file_full
-                logger.info(f"Server doesn't support resume.")
-            
+            download_method, content_length = get_download_method(url, use_head)
             for i in range(max_retries):
+                if stop_requested(cancel_event):
+                    raise KeyboardInterrupt
                 logger.info(f"Download Attempt {i+1}")
-                checksum = download_method(url, specific_local_file, content_length)
-                if checksum:                    
+                checksums = download_method(url, specific_local_file, content_length, algorithms, cancel_event)
+                if checksums:                    
                     match = ""
-                    if expected_checksum:
+                    if expected_checksums:
                         match = ", Checksum Match"
 
-                    if expected_checksum and expected_checksum != checksum:
-                        logger.info(f"Checksum doesn't match. Calculated {checksum} Expecting: {expected_checksum}")                            
+                    mismatches = get_mismatches(expected_checksums, checksums)
+                    if mismatches:
+                        logger.info(f"Checksum doesn't match. Calculated {checksums} Expecting: {expected_checksums}")                            
                     else:
-                        logger.info(f"Download successful{match}. Checksum {checksum}")
+                        logger.info(f"Download successful{match}. Checksum {checksums}")
                         success = True
                         break
+                # The remote may have changed, don't go on with cached metadata
+                download_method, content_length = get_download_method(url, use_head, use_cache=False)
                 time.sleep(1)
 
             if success:
@@ -208,4 +454,13 @@ def download_file(urls, expected_checksum=None, local_file=None, local_directory
     except Exception as ex: 
         logger.info(f"Unexpected Error: {ex}") # Only from block above
 
+    if return_checksums:
+        return checksums if success else None
     return success
+
+from best_download.mirror import mirror_directory
+from best_download.buffer import download_into, download_bytes
+from best_download.ranges import fetch_ranges
+from best_download.prefetch import Prefetcher
+from best_download.cache_server import cached_url, serve_cache
+from best_download.cooperative import cooperative_download
@@ -0,0 +1,4 @@
+import sys
+from best_download.cli import main
+
+sys.exit(main())
@@ -0,0 +1,153 @@
+import time
+
+from tqdm import tqdm
+
+import best_download
+from best_download import get_file_info_from_server
+from best_download.checksums import MultiHasher, parse_expected_checksum, get_algorithms, get_mismatches
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Destination for an in-memory download. Fixed buffers (bytearray, mmap, numpy array
+# or anything else exposing a writable buffer) are written in place through a
+# memoryview. Growable buffers are only used when the size isn't known up front.
+class BufferTarget():
+    def __init__(self, buffer, growable, algorithms):
+        self.buffer = buffer
+        self.growable = growable
+        self.algorithms = algorithms
+        self.reset()
+
+    def reset(self):
+        self.position = 0
+        self.checksum = MultiHasher(self.algorithms)
+        if self.growable:
+            del self.buffer[:]
+
+    def write(self, view, chunk):
+        end = self.position + len(chunk)
+        if self.growable:
+            self.buffer[self.position:end] = chunk
+        else:
+            if end > len(view):
+                raise ValueError(f"Buffer too small, {len(view)} bytes")
+            view[self.position:end] = chunk
+        self.checksum.update(chunk)
+        self.position = end
+
+# Streams url into target from target.position onwards, using a Range request to
+# resume. Returns True once content_length bytes (or the whole body when the length
+# is unknown) have been written.
+def download_buffer_attempt(url, target, content_length):
+    headers = {"Accept-Encoding": "identity"} # Avoid dealing with gzip
+    if target.position:
+        headers["Range"] = f"bytes={target.position}-"
+
+    view = None
+    try:
+        with tqdm(total=content_length, unit="byte", unit_scale=1) as progress, \
+             best_download.transport.get(url, headers=headers, timeout=5) as response:
+
+            response.raise_for_status()
+
+            # Server ignored the range, start again from the beginning
+            if target.position and response.status_code != 206:
+                logger.info("Range not honoured, restarting download.")
+                target.reset()
+
+            progress.update(target.position)
+            if not target.growable:
+                view = memoryview(target.buffer).cast("B")
+
+            for chunk in response.iter_content(best_download.chunk_size):
+                target.write(view, chunk)
+                progress.update(len(chunk))
+
+    except KeyboardInterrupt as ex:
+        raise ex
+    except Exception as ex:
+        logger.info(f"Download error: {ex}")
+        return False
+    finally:
+        if view is not None:
+            view.release()
+
+    if content_length is not None and target.position != content_length:
+        logger.info(f"Incomplete download, {target.position} of {content_length} bytes.")
+        return False
+    return True
+
+# Shared failover/retry/verification loop for download_into and download_bytes.
+# With buffer None a new bytearray is allocated for each url. Returns
+# (buffer, size, checksums) on success, None on failure.
+def download_to_buffer(urls, buffer, expected_checksum, max_retries, hash_algorithms):
+    if not isinstance(urls, list):
+        urls = [urls]
+
+    expected_checksums = parse_expected_checksum(expected_checksum)
+    algorithms = get_algorithms(expected_checksums, hash_algorithms)
+
+    try:
+        for url in urls:
+            accept_ranges, content_length = get_file_info_from_server(url)
+            logger.info(f"Accept-Ranges: {accept_ranges}. content length: {content_length}")
+            if buffer is None:
+                target = BufferTarget(bytearray(content_length or 0), not content_length, algorithms)
+            elif content_length and content_length > memoryview(buffer).nbytes:
+                logger.info(f"Buffer of {memoryview(buffer).nbytes} bytes too small for {content_length} bytes.")
+                continue
+            else:
+                target = BufferTarget(buffer, False, algorithms)
+
+            for i in range(max_retries):
+                logger.info(f"Download Attempt {i+1}")
+                # Only continue where the last attempt stopped if the server supports it
+                if target.position and not (accept_ranges and content_length):
+                    target.reset()
+
+                if download_buffer_attempt(url, target, content_length):
+                    checksums = target.checksum.hexdigests()
+                    if get_mismatches(expected_checksums, checksums):
+                        logger.info(f"Checksum doesn't match. Calculated {checksums} Expecting: {expected_checksums}")
+                        target.reset()
+                    else:
+                        logger.info(f"Download successful. Checksum {checksums}")
+                        return target.buffer, target.position, checksums
+                time.sleep(1)
+
+            logger.info(f"Failed downloading url '{url}'")
+
+    except KeyboardInterrupt as ex:
+        logger.info('SIGINT or CTRL-C detected, stopping.')
+        raise ex
+    except Exception as ex:
+        logger.info(f"Unexpected Error: {ex}")
+
+    return None
+
+# Downloads into a caller supplied writable buffer (bytearray, mmap, numpy array...)
+# in place, no temporary or checkpoint files. Failed attempts resume from the bytes
+# already in the buffer when the server supports ranges. Returns the number of bytes
+# written or None on failure, with return_checksums (size, checksums) instead.
+def download_into(urls, buffer, expected_checksum=None, max_retries=3, hash_algorithms=None,
+                  return_checksums=False):
+    result = download_to_buffer(urls, buffer, expected_checksum, max_retries, hash_algorithms)
+    if result is None:
+        return None
+    buffer, size, checksums = result
+    if return_checksums:
+        return size, checksums
+    return size
+
+# Downloads into a new bytearray, preallocated when the server reports the size.
+# Returns the bytearray or None on failure, with return_checksums (bytearray, checksums).
+def download_bytes(urls, expected_checksum=None, max_retries=3, hash_algorithms=None,
+                   return_checksums=False):
+    result = download_to_buffer(urls, None, expected_checksum, max_retries, hash_algorithms)
+    if result is None:
+        return None
+    buffer, size, checksums = result
+    if return_checksums:
+        return buffer, checksums
+    return buffer
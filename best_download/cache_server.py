@@ -0,0 +1,336 @@
+import os
+import re
+import sys
+import json
+import pickle
+import hashlib
+import argparse
+import ipaddress
+import threading
+from urllib.parse import urlparse, quote, unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from best_download import download_file, get_file_metadata
+from best_download.checksums import parse_expected_checksum, get_mismatches, hash_file
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Node-local caching HTTP server. Every upstream object is fetched once with
+# download_file (checkpointed, so a restarted server resumes interrupted fills) and
+# served to any number of local clients, with Range support, while the fill is still
+# running. Clients put the cache first in their urls and keep the origin for failover:
+#
+#   download_file([cached_url("http://cachehost:6200", url, checksum), url],
+#                 expected_checksum=checksum)
+#
+# Cache urls are /<scheme>/<host>/<path>?<query> so the file name is preserved.
+# An expected checksum passed through cached_url (the bd_checksum query parameter) is
+# verified by the fill. A request whose checksum doesn't match the cached object gets
+# a 409 (the client fails over) and the object stays cached. Cached objects are
+# assumed immutable, nothing is revalidated upstream. Listening beyond loopback needs
+# allowed_hosts (--allow-host), the server would otherwise be an open proxy.
+
+checksum_parameter = "bd_checksum"
+serve_chunk_size = 1024*1024
+
+# Url of url on the cache server at cache_url. expected_checksum is a string as
+# accepted by download_file ("<sha256>" or "md5:<digest>").
+def cached_url(cache_url, url, expected_checksum=None):
+    parsed = urlparse(url)
+    result = f"{cache_url.rstrip('/')}/{parsed.scheme}/{parsed.netloc}{parsed.path or '/'}"
+    query = parsed.query
+    if expected_checksum:
+        checksum_query = f"{checksum_parameter}={quote(expected_checksum, safe=':')}"
+        query = f"{query}&{checksum_query}" if query else checksum_query
+    if query:
+        result += "?" + query
+    return result
+
+# Inverse of cached_url, returns (upstream url, expected checksum) or None.
+def parse_cached_path(path):
+    path, _, query = path.partition("?")
+    match = re.match(r"^/(https?)/([^/]+)(/.*)$", path)
+    if not match:
+        return None
+    expected_checksum = None
+    parameters = []
+    for parameter in query.split("&") if query else []:
+        if parameter.startswith(checksum_parameter + "="):
+            expected_checksum = unquote(parameter[len(checksum_parameter) + 1:])
+        else:
+            parameters.append(parameter)
+    url = f"{match.group(1)}://{match.group(2)}{match.group(3)}"
+    if parameters:
+        url += "?" + "&".join(parameters)
+    return url, expected_checksum
+
+# "bytes=100-199", "bytes=100-" or "bytes=-50" -> (start, end). None for no header,
+# several ranges or anything else we serve as a plain 200. "unsatisfiable" when out
+# of bounds.
+def parse_single_range(range_header, size):
+    match = re.match(r"^bytes=(\d*)-(\d*)$", (range_header or "").strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):
+        start, end = max(size - int(match.group(2)), 0), size - 1
+    else:
+        start = int(match.group(1))
+        end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+    if start > end:
+        return "unsatisfiable"
+    return start, end
+
+# One upstream fetch. The HEAD result (size, validators) is available as soon as
+# ready is set, the data file then grows as download_file writes it.
+class Fill():
+    def __init__(self, cache, url, key, expected_checksum):
+        self.cache = cache
+        self.url = url
+        self.key = key
+        self.expected_checksum = expected_checksum
+        self.metadata = None
+        self.success = False
+        self.ready = threading.Event()
+        self.finished = threading.Event()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        data_file = self.cache.data_file(self.key)
+        try:
+            self.metadata = get_file_metadata(self.url, use_cache=False)
+            if not self.metadata:
+                return
+
+            # Give download_file a checkpoint to resume from even when starting fresh,
+            # so it appends to the file readers already have open instead of
+            # replacing it. After a restart the checkpoint left behind is used as is.
+            if not os.path.exists(data_file + ".ckpnt") or not os.path.exists(data_file):
+                open(data_file, "wb").close()
+                pickle.dump(0, open(data_file + ".ckpnt", "wb"))
+            self.ready.set()
+
+            logger.info(f"Filling cache from {self.url}")
+            checksums = download_file(self.url, expected_checksum=self.expected_checksum, local_file=data_file,
+                                      max_retries=self.cache.max_retries, hash_algorithms=["sha256"],
+                                      return_checksums=True)
+            if checksums:
+                if os.path.exists(data_file + ".ckpnt"):
+                    os.remove(data_file + ".ckpnt") # Left over from a server without ranges
+                self.cache.write_info(self.key, {
+                    "url": self.url,
+                    "size": os.path.getsize(data_file),
+                    "checksums": checksums,
+                    "etag": self.metadata["etag"],
+                    "last_modified": self.metadata["last_modified"],
+                })
+                self.success = True
+            else:
+                logger.info(f"Cache fill failed for {self.url}")
+        except Exception as ex:
+            logger.info(f"Unexpected Error filling {self.url}: {ex}")
+        finally:
+            self.cache.fill_finished(self.key)
+            self.ready.set()
+            self.finished.set()
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+class CacheServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, cache_directory, host="localhost", port=6200, allowed_hosts=None, max_retries=3):
+        if allowed_hosts is None and not is_loopback(host):
+            raise ValueError(f"Listening on {host} requires allowed_hosts")
+        self.cache_directory = cache_directory
+        self.allowed_hosts = allowed_hosts
+        self.max_retries = max_retries
+        self.fills = {}
+        self.lock = threading.Lock()
+        os.makedirs(cache_directory, exist_ok=True)
+        super().__init__((host, port), CacheHandler)
+
+    def data_file(self, key):
+        return os.path.join(self.cache_directory, key)
+
+    def read_info(self, key):
+        try:
+            with open(self.data_file(key) + ".json", "r") as fh:
+                info = json.load(fh)
+            if os.path.getsize(self.data_file(key)) == info["size"]:
+                return info
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def write_info(self, key, info):
+        info_file = self.data_file(key) + ".json"
+        with open(info_file + ".tmp", "w") as fh:
+            json.dump(info, fh)
+        os.replace(info_file + ".tmp", info_file)
+
+    def fill_finished(self, key):
+        with self.lock:
+            self.fills.pop(key, None)
+
+    # Returns (info, None) for a complete object or (None, fill) for one being fetched,
+    # starting the fill if needed. (None, None) when the complete object doesn't match
+    # expected_checksum, it stays cached for everyone else rather than being fetched
+    # again under readers.
+    def lookup(self, url, expected_checksum):
+        key = hashlib.sha256(url.encode()).hexdigest()
+        with self.lock:
+            fill = self.fills.get(key)
+            if fill:
+                return None, fill
+            info = self.read_info(key)
+            if not info:
+                fill = Fill(self, url, key, expected_checksum)
+                self.fills[key] = fill
+                return None, fill
+
+        # Hashing a large object mustn't hold up every other request
+        expected_checksums = parse_expected_checksum(expected_checksum)
+        missing = [algorithm for algorithm in expected_checksums if algorithm not in info["checksums"]]
+        if missing:
+            checksums = hash_file(self.data_file(key), missing)
+            with self.lock:
+                info = self.read_info(key) or info
+                info["checksums"].update(checksums)
+                self.write_info(key, info)
+
+        if get_mismatches(expected_checksums, info["checksums"]):
+            logger.info(f"Cached {url} doesn't match {expected_checksum}.")
+            return None, None
+        return info, None
+
+class CacheHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_empty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def handle_request(self, send_body):
+        parsed = parse_cached_path(self.path)
+        if not parsed:
+            return self.send_empty(404)
+        url, expected_checksum = parsed
+        if self.server.allowed_hosts is not None and urlparse(url).hostname not in self.server.allowed_hosts:
+            return self.send_empty(403)
+        try:
+            parse_expected_checksum(expected_checksum)
+        except ValueError:
+            return self.send_empty(400)
+
+        info, fill = self.server.lookup(url, expected_checksum)
+        if not info and not fill:
+            return self.send_empty(409)
+        if fill:
+            fill.ready.wait()
+            if not fill.metadata:
+                return self.send_empty(502)
+            size = fill.metadata["content_length"]
+            if size is None: # Upstream didn't say, wait for the whole object
+                fill.finished.wait()
+                if not fill.success:
+                    return self.send_empty(502)
+                info, fill = self.server.lookup(url, expected_checksum)
+                if not info:
+                    return self.send_empty(409 if not fill else 503)
+        if info:
+            size = info["size"]
+
+        byte_range = parse_single_range(self.headers.get("Range"), size)
+        if byte_range == "unsatisfiable":
+            return self.send_empty(416, {"Content-Range": f"bytes */{size}"})
+        if byte_range:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        else:
+            start, end = 0, size - 1
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("X-Cache", "hit" if info else "fill")
+        if info:
+            self.send_header("X-Checksum-Sha256", info["checksums"]["sha256"])
+        self.end_headers()
+
+        if send_body and end >= start:
+            self.send_body(self.server.data_file(hashlib.sha256(url.encode()).hexdigest()), start, end, fill)
+
+    # Copies start-end from the data file, waiting for the fill where it hasn't got
+    # that far yet. The connection is dropped if the fill fails or starts over, the
+    # client sees a short read and retries or fails over.
+    def send_body(self, data_file, start, end, fill):
+        position = start
+        try:
+            with open(data_file, "rb") as fh:
+                while position <= end:
+                    available = os.fstat(fh.fileno()).st_size
+                    if available > position:
+                        fh.seek(position)
+                        data = fh.read(min(serve_chunk_size, end + 1 - position, available - position))
+                        self.wfile.write(data)
+                        position += len(data)
+                    elif fill is None or fill.finished.is_set() and os.fstat(fh.fileno()).st_size <= position:
+                        logger.info(f"Fill stopped at {available} bytes, dropping connection.")
+                        self.close_connection = True
+                        return
+                    else:
+                        fill.finished.wait(0.01)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+def serve_cache(cache_directory, host="localhost", port=6200, allowed_hosts=None):
+    server = CacheServer(cache_directory, host, port, allowed_hosts)
+    logger.info(f"Cache server started http://{host}:{server.server_address[1]} in {cache_directory}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="best-download-cache",
+        description="Node-local caching server, fetches each upstream object once and serves it to local "
+                    "clients. Point clients at it with best_download.cache_server.cached_url.")
+    parser.add_argument("directory", help="Cache directory, interrupted fills resume from here after a restart.")
+    parser.add_argument("--host", default="localhost", help="Address to listen on (default: localhost).")
+    parser.add_argument("--port", type=int, default=6200, help="Port to listen on (default: 6200).")
+    parser.add_argument("--allow-host", action="append", dest="allowed_hosts",
+                        help="Only fetch from this upstream host. Repeatable, required unless --host is "
+                             "loopback, default any host.")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log fills to stderr.")
+    args = parser.parse_args(argv)
+    if args.allowed_hosts is None and not is_loopback(args.host):
+        parser.error(f"--allow-host is required when listening on {args.host}")
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(message)s")
+    serve_cache(args.directory, args.host, args.port, args.allowed_hosts)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
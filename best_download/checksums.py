@@ -0,0 +1,118 @@
+import zlib
+import hashlib
+
+# Optional fast non-cryptographic hashes, "pip install best-download[fast_hash]"
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+default_algorithm = "sha256"
+
+xxhash_algorithms = ["xxh32", "xxh64", "xxh3_64", "xxh128", "xxh3_128"]
+
+# hashlib-like wrapper for running CRC32 checksums (zlib or crc32c)
+class CrcHash():
+    def __init__(self, name, function):
+        self.name = name
+        self.function = function
+        self.value = 0
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def digest(self):
+        return self.value.to_bytes(4, "big")
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+# Accept the usual spellings, "SHA-256", "sha256", "Blake2b", "xxh3-64" etc.
+def normalise_algorithm(algorithm):
+    algorithm = algorithm.strip().lower()
+    compact = algorithm.replace("-", "")
+    if compact in hashlib.algorithms_available or compact in ["crc32", "crc32c"]:
+        return compact
+    return algorithm.replace("-", "_")
+
+def get_hasher(algorithm):
+    algorithm = normalise_algorithm(algorithm)
+    if algorithm == "crc32":
+        return CrcHash(algorithm, zlib.crc32)
+    if algorithm == "crc32c":
+        if crc32c is None:
+            raise ValueError("crc32c checksums need the crc32c package, pip install crc32c")
+        return CrcHash(algorithm, crc32c.crc32c)
+    if algorithm in xxhash_algorithms:
+        if xxhash is None:
+            raise ValueError(f"{algorithm} checksums need the xxhash package, pip install xxhash")
+        return getattr(xxhash, algorithm)()
+    if algorithm in hashlib.algorithms_available:
+        return hashlib.new(algorithm)
+    raise ValueError(f"Unsupported checksum algorithm '{algorithm}'")
+
+# expected_checksum can be a plain hex digest (sha256 for backwards compatibility),
+# an algorithm-tagged digest like "md5:9e107d9d..." or a dict of {algorithm: digest}.
+# Returns a dict of {algorithm: lowercase hex digest}.
+def parse_expected_checksum(expected_checksum):
+    if not expected_checksum:
+        return {}
+
+    if isinstance(expected_checksum, dict):
+        items = expected_checksum.items()
+    elif ":" in expected_checksum:
+        items = [expected_checksum.split(":", 1)]
+    else:
+        items = [(default_algorithm, expected_checksum)]
+
+    # S3 ETags come quoted
+    parsed = {normalise_algorithm(algorithm): digest.strip().strip('"').lower() for algorithm, digest in items}
+    for algorithm in parsed:
+        get_hasher(algorithm) # Fail early on unknown/unavailable algorithms
+    return parsed
+
+# Every algorithm that needs computing for a download, defaulting to sha256.
+def get_algorithms(expected_checksums, hash_algorithms=None):
+    algorithms = list(expected_checksums)
+    for algorithm in hash_algorithms or []:
+        algorithm = normalise_algorithm(algorithm)
+        get_hasher(algorithm)
+        if algorithm not in algorithms:
+            algorithms.append(algorithm)
+    return algorithms or [default_algorithm]
+
+# Feeds each buffer to every requested hasher so all digests come from one pass.
+class MultiHasher():
+    def __init__(self, algorithms):
+        self.hashers = {normalise_algorithm(algorithm): get_hasher(algorithm) for algorithm in algorithms}
+
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+
+    def hexdigests(self):
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()}
+
+# Returns the algorithms whose computed digest doesn't match the expected one.
+def get_mismatches(expected_checksums, checksums):
+    return [algorithm for algorithm, digest in expected_checksums.items()
+            if checksums.get(algorithm) != digest]
+
+def hash_file(local_file, algorithms, chunk_size=1024*1024):
+    hasher = MultiHasher(algorithms)
+    with open(local_file, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher.hexdigests()
+
+# Re-reads local_file to check it against expected_checksum (any form accepted by
+# parse_expected_checksum).
+def file_matches_checksum(local_file, expected_checksum, chunk_size=1024*1024):
+    expected_checksums = parse_expected_checksum(expected_checksum)
+    checksums = hash_file(local_file, list(expected_checksums), chunk_size)
+    return not get_mismatches(expected_checksums, checksums)
@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from best_download import download_file, get_local_file, get_file_metadata, probe_file_metadata, \
+                          set_connection_pool_size, set_transport, stop_event
+from best_download.checksums import file_matches_checksum, parse_expected_checksum, get_algorithms
+
+import logging
+logger = logging.getLogger(__name__)
+
+exit_success = 0
+exit_failed = 1
+exit_usage = 2
+exit_interrupted = 130
+
+# Each input line is "url [checksum] [output]", whitespace separated. Checksums are
+# sha256 or algorithm-tagged ("md5:..."), use "-" to give an output path without one.
+# Blank lines and # comments are skipped.
+def parse_line(line):
+    fields = line.split()
+    if not fields or fields[0].startswith("#"):
+        return None
+    if len(fields) > 3:
+        raise ValueError(f"Expected 'url [checksum] [output]', got '{line.strip()}'")
+
+    url = fields[0]
+    checksum = fields[1] if len(fields) > 1 and fields[1] != "-" else None
+    output = fields[2] if len(fields) > 2 else None
+    parse_expected_checksum(checksum) # Reject unknown algorithms up front
+    return {"url": url, "checksum": checksum, "output": output}
+
+def read_jobs(args):
+    lines = list(args.urls)
+    if args.input_file:
+        if args.input_file == "-":
+            lines.extend(sys.stdin.read().splitlines())
+        else:
+            with open(args.input_file, "r") as fh:
+                lines.extend(fh.read().splitlines())
+
+    jobs = []
+    for line in lines:
+        job = parse_line(line)
+        if job:
+            job["local_file"] = get_local_file(job["url"], job["output"], args.directory)
+            jobs.append(job)
+    return jobs
+
+# A completed earlier run leaves the file without a checkpoint next to it. That alone
+# proves nothing (full downloads never checkpoint and a resumable one can die before
+# its first), so the checksum has to match or, without one, the size has to match a
+# fresh HEAD (a one byte ranged GET with --no-head).
+def already_downloaded(job, no_head):
+    local_file = job["local_file"]
+    if not os.path.exists(local_file) or os.path.exists(local_file + ".ckpnt"):
+        return False
+    if job["checksum"]:
+        return file_matches_checksum(local_file, job["checksum"])
+    if no_head:
+        metadata = probe_file_metadata(job["url"])
+    else:
+        metadata = get_file_metadata(job["url"], use_cache=False)
+    return bool(metadata) and metadata["content_length"] == os.path.getsize(local_file)
+
+def run_job(job, args):
+    result = {"url": job["url"], "local_file": job["local_file"], "skipped": False, "checksums": None}
+    start = time.perf_counter()
+    if not args.overwrite and already_downloaded(job, args.no_head):
+        logger.info(f"Already downloaded: {job['local_file']}")
+        result["skipped"] = True
+        result["success"] = True
+    else:
+        directory = os.path.dirname(job["local_file"])
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        result["checksums"] = download_file(job["url"], expected_checksum=job["checksum"],
+                                            local_file=job["local_file"], max_retries=args.max_retries,
+                                            hash_algorithms=args.hash, return_checksums=True,
+                                            use_head=not args.no_head)
+        result["success"] = result["checksums"] is not None
+    seconds = time.perf_counter() - start
+
+    size = os.path.getsize(job["local_file"]) if result["success"] else 0
+    result["bytes"] = size
+    result["seconds"] = round(seconds, 3)
+    result["mb_per_second"] = round(size / seconds / 1e6, 3) if seconds > 0 and not result["skipped"] else None
+    return result
+
+def write_summary(results, seconds, summary_path):
+    total_bytes = sum(result["bytes"] for result in results if not result["skipped"])
+    summary = {
+        "files": results,
+        "succeeded": sum(1 for result in results if result["success"]),
+        "failed": sum(1 for result in results if not result["success"]),
+        "skipped": sum(1 for result in results if result["skipped"]),
+        "bytes": total_bytes,
+        "seconds": round(seconds, 3),
+        "mb_per_second": round(total_bytes / seconds / 1e6, 3) if seconds > 0 else None,
+    }
+    if summary_path == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(summary_path, "w") as fh:
+            json.dump(summary, fh, indent=2)
+
+def get_parser():
+    parser = argparse.ArgumentParser(prog="best-download",
+        description="Download urls concurrently with checkpointing and checksumming. "
+                    "Interrupted downloads resume when re-run.")
+    parser.add_argument("urls", nargs="*", help="Urls to download, 'url [checksum] [output]' also accepted.")
+    parser.add_argument("-i", "--input-file", help="File with one 'url [checksum] [output]' per line, '-' for stdin.")
+    parser.add_argument("-d", "--directory", help="Directory to download into, prepended to output paths.")
+    parser.add_argument("-j", "--jobs", type=int, default=4, help="Number of concurrent downloads (default: 4).")
+    parser.add_argument("--max-retries", type=int, default=3, help="Retry attempts per url (default: 3).")
+    parser.add_argument("--hash", action="append",
+                        help="Extra digest to compute and report in the summary, e.g. md5, blake2b, xxh64. Repeatable.")
+    parser.add_argument("--no-head", action="store_true",
+                        help="Skip HEAD requests, learn size and range support from the first ranged GET.")
+    parser.add_argument("--http2", action="store_true",
+                        help="Use HTTP/2 where the server offers it, needs best-download[http2].")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Download again even if a completed file is already present.")
+    parser.add_argument("--summary", default="-", help="Where to write the json summary, '-' for stdout (default).")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Log progress to stderr.")
+    return parser
+
+# Exit status is 0 when every download succeeded, 1 if any failed, 2 for bad input
+# and 130 when interrupted.
+def main(argv=None):
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(message)s")
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    try:
+        get_algorithms({}, args.hash)
+        jobs = read_jobs(args)
+    except (OSError, ValueError) as ex:
+        print(f"best-download: {ex}", file=sys.stderr)
+        return exit_usage
+    if not jobs:
+        print("best-download: no urls provided", file=sys.stderr)
+        return exit_usage
+
+    # Keep one warm connection per worker
+    set_connection_pool_size(max(args.jobs, 10))
+    if args.http2:
+        try:
+            set_transport("http2", max_connections=max(args.jobs, 4))
+        except ImportError as ex:
+            print(f"best-download: {ex}", file=sys.stderr)
+            return exit_usage
+
+    start = time.perf_counter()
+    results = [None] * len(jobs)
+    executor = ThreadPoolExecutor(max_workers=args.jobs)
+    futures = {executor.submit(run_job, job, args): i for i, job in enumerate(jobs)}
+    try:
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as ex:
+                logger.info(f"Unexpected Error downloading '{jobs[i]['url']}': {ex}")
+                results[i] = {"url": jobs[i]["url"], "local_file": jobs[i]["local_file"], "skipped": False,
+                              "checksums": None, "success": False, "bytes": 0, "seconds": None, "mb_per_second": None}
+    except KeyboardInterrupt:
+        logger.warning("SIGINT or CTRL-C detected, stopping active downloads. Re-run to resume.")
+        for future in futures:
+            future.cancel()
+        stop_event.set()
+        executor.shutdown(wait=True)
+        stop_event.clear()
+        return exit_interrupted
+    finally:
+        executor.shutdown(wait=False)
+
+    write_summary(results, time.perf_counter() - start, args.summary)
+    if all(result["success"] for result in results):
+        return exit_success
+    return exit_failed
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,415 @@
+import os
+import re
+import json
+import math
+import time
+import queue
+import pickle
+import random
+import hashlib
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import best_download
+from best_download import get_file_info_from_server
+from best_download.ranges import fetch_ranges, FileWriter
+from best_download.checksums import parse_expected_checksum, get_algorithms, get_mismatches, hash_file
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Cooperative download of one large object onto several nodes. The object is split
+# into segments and every participant fetches a disjoint contiguous share from the
+# origin, so the origin serves each byte about once. The rest comes from the other
+# participants over a small HTTP protocol served by each of them:
+#   GET /segments     json {"size", "segment_size", "have": "0110...", "complete"}
+#   GET /segment/<i>  segment bytes, sha256 in the X-Segment-Sha256 header
+# Every segment pulled from a peer is hashed and checked against segment_checksums
+# when given, otherwise against the hash the sending peer computed. Shares of peers
+# that stay unreachable for peer_timeout, and segments that repeatedly fail
+# verification, are fetched from the origin instead.
+
+default_segment_size = 64*1024*1024
+poll_interval = 0.25
+# Segments per origin request, contiguous within a share so each batch is one range
+origin_batch_segments = 4
+max_peer_failures = 2
+# Threads polling peer status, separate from the segment pulls so liveness tracking
+# doesn't wait behind them
+max_status_workers = 8
+
+# Peers get their own pool without the retry adapter, an unreachable peer should
+# fail fast so we move on to another peer or the origin.
+peer_session = requests.Session()
+
+def as_peer_url(peer):
+    if "://" not in peer:
+        peer = "http://" + peer
+    return peer.rstrip("/")
+
+# Which participant fetches segment from the origin, contiguous shares in rank order.
+def get_owner(segment, segment_count, participant_count):
+    return segment * participant_count // segment_count
+
+# Local copy of the object plus which segments are present and verified. Verified
+# segments are checkpointed to local_file + ".segments" so an interrupted participant
+# picks up where it stopped.
+class SegmentState():
+    def __init__(self, local_file, size, segment_size, segment_checksums):
+        self.local_file = local_file
+        self.size = size
+        self.segment_size = segment_size
+        self.segment_count = math.ceil(size / segment_size)
+        self.segment_checksums = segment_checksums
+        self.checkpoint = local_file + ".segments"
+        self.lock = threading.Lock()
+
+        self.hashes = {}
+        try:
+            saved = pickle.load(open(self.checkpoint, "rb"))
+            assert saved["size"] == size and saved["segment_size"] == segment_size
+            assert os.path.getsize(local_file) == size
+            self.hashes = saved["hashes"]
+            logger.info(f"Resuming with {len(self.hashes)} of {self.segment_count} segments.")
+        except:
+            with open(local_file, "wb") as fh:
+                fh.truncate(size)
+
+        self.file_out = open(local_file, "r+b")
+        self.file_writer = FileWriter(self.file_out)
+
+    def close(self):
+        self.file_out.close()
+
+    def segment_range(self, segment):
+        start = segment * self.segment_size
+        return start, min(self.segment_size, self.size - start)
+
+    def has(self, segment):
+        return segment in self.hashes
+
+    def complete(self):
+        return len(self.hashes) == self.segment_count
+
+    def missing(self):
+        return [segment for segment in range(self.segment_count) if segment not in self.hashes]
+
+    def mark(self, segment, digest):
+        # Peers read it back through their own file handle
+        with self.file_writer.lock:
+            self.file_out.flush()
+        with self.lock:
+            self.hashes[segment] = digest
+            pickle.dump({"size": self.size, "segment_size": self.segment_size, "hashes": self.hashes},
+                        open(self.checkpoint, "wb"))
+
+    def status(self):
+        with self.lock:
+            have = "".join("1" if segment in self.hashes else "0" for segment in range(self.segment_count))
+        return {"size": self.size, "segment_size": self.segment_size, "have": have,
+                "complete": self.complete()}
+
+    def hash_segment(self, segment):
+        start, length = self.segment_range(segment)
+        hasher = hashlib.sha256()
+        with open(self.local_file, "rb") as fh:
+            fh.seek(start)
+            while length:
+                data = fh.read(min(best_download.chunk_size, length))
+                if not data:
+                    break
+                hasher.update(data)
+                length -= len(data)
+        return hasher.hexdigest()
+
+    # Segment hash we trust: the published list, or failing that what the sender says.
+    def expected_hash(self, segment, sender_hash):
+        if self.segment_checksums:
+            return self.segment_checksums[segment]
+        return sender_hash
+
+class SegmentHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+    def send_json(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        state = self.server.state
+        if self.path == "/segments":
+            return self.send_json(state.status())
+
+        match = re.match(r"^/segment/(\d+)$", self.path)
+        if not match or not state.has(int(match.group(1))):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        segment = int(match.group(1))
+        start, length = state.segment_range(segment)
+        self.send_response(200)
+        self.send_header("Content-Length", str(length))
+        self.send_header("X-Segment-Sha256", state.hashes[segment])
+        self.end_headers()
+        try:
+            with open(state.local_file, "rb") as fh:
+                fh.seek(start)
+                while length:
+                    data = fh.read(min(best_download.chunk_size, length))
+                    self.wfile.write(data)
+                    length -= len(data)
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+
+class SegmentServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, state):
+        self.state = state
+        super().__init__(address, SegmentHandler)
+
+def get_peer_status(peer_url):
+    try:
+        response = peer_session.get(f"{peer_url}/segments", timeout=2)
+        response.raise_for_status()
+        return response.json()
+    except Exception as ex:
+        logger.debug(f"Peer {peer_url} unavailable: {ex}")
+        return None
+
+# Streams segment from a peer into place and verifies it. Returns True if it's now
+# marked present.
+def pull_segment(peer_url, segment, state):
+    start, length = state.segment_range(segment)
+    try:
+        hasher = hashlib.sha256()
+        position = start
+        with peer_session.get(f"{peer_url}/segment/{segment}", stream=True, timeout=5) as response:
+            response.raise_for_status()
+            sender_hash = response.headers.get("X-Segment-Sha256")
+            for chunk in response.iter_content(best_download.chunk_size):
+                if position + len(chunk) > start + length:
+                    raise ValueError("Segment longer than expected")
+                state.file_writer.write(position, chunk)
+                hasher.update(chunk)
+                position += len(chunk)
+
+        if position != start + length:
+            raise ValueError(f"Short segment, {position - start} of {length} bytes")
+        digest = hasher.hexdigest()
+        if digest != state.expected_hash(segment, sender_hash):
+            raise ValueError(f"Segment hash mismatch, got {digest}")
+        state.mark(segment, digest)
+        return True
+    except Exception as ex:
+        logger.info(f"Segment {segment} from {peer_url} failed: {ex}")
+        return False
+
+# Fetches batches of segments from the origin with fetch_ranges and verifies them,
+# one batch at a time from a queue. Batches that can't be fetched or verified after
+# max_retries are recorded in failed.
+class OriginFetcher():
+    def __init__(self, urls, state, max_retries):
+        self.urls = urls
+        self.state = state
+        self.max_retries = max_retries
+        self.queue = queue.Queue()
+        self.queued = set()
+        self.failed = set()
+        self.bytes = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def add(self, segments):
+        segments = [segment for segment in segments if segment not in self.queued]
+        self.queued.update(segments)
+        for i in range(0, len(segments), origin_batch_segments):
+            self.queue.put(segments[i:i + origin_batch_segments])
+
+    def idle(self):
+        return self.queue.unfinished_tasks == 0
+
+    def stop(self):
+        self.queue.put(None)
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                self.queue.task_done()
+                return
+            try:
+                self.fetch(batch)
+            finally:
+                self.queue.task_done()
+
+    def fetch(self, batch):
+        batch = [segment for segment in batch if not self.state.has(segment)]
+        for i in range(self.max_retries):
+            if not batch:
+                return
+            ranges = [self.state.segment_range(segment) for segment in batch]
+            if fetch_ranges(self.urls, ranges, local_file=self.state.local_file, max_retries=1) is not None:
+                self.bytes += sum(length for _, length in ranges)
+                # Only published segment checksums can catch a bad origin read
+                for segment in batch:
+                    digest = self.state.hash_segment(segment)
+                    if not self.state.segment_checksums or digest == self.state.segment_checksums[segment]:
+                        self.state.mark(segment, digest)
+                    else:
+                        logger.info(f"Segment {segment} from origin doesn't match its checksum.")
+                batch = [segment for segment in batch if not self.state.has(segment)]
+        if batch:
+            logger.info(f"Failed fetching segments {batch} from origin.")
+            self.failed.update(batch)
+            self.queued.difference_update(batch)
+
+# Cooperative download of urls into local_file shared between participants. peers
+# lists every participant ("host:port" or url) in the same order on all of them, rank
+# is our index in it and where our segment server listens. Each participant fetches
+# its own share of segments from the origin and pulls the rest from the others,
+# falling back to the origin for shares whose participant isn't reachable for
+# peer_timeout seconds. segment_checksums (sha256 per segment, e.g. published with
+# the object) protects against bad peers, without it segments are checked against
+# the hash the sending peer computed. expected_checksum is verified over the whole
+# file at the end as in download_file. Once complete we keep serving until every
+# peer is complete or gone, at most linger seconds. The origin must support ranges.
+# Returns True/False.
+def cooperative_download(urls, local_file, peers, rank, expected_checksum=None,
+                         segment_size=default_segment_size, segment_checksums=None, max_retries=3,
+                         max_workers=4, peer_timeout=30, linger=60):
+
+    if not isinstance(urls, list):
+        urls = [urls]
+    expected_checksums = parse_expected_checksum(expected_checksum)
+    peers = [as_peer_url(peer) for peer in peers]
+
+    accept_ranges, size = get_file_info_from_server(urls[0])
+    if not (accept_ranges and size):
+        logger.info(f"Cooperative download needs range support and a known size, "
+                    f"Accept-Ranges: {accept_ranges}. content length: {size}")
+        return False
+    segment_count = math.ceil(size / segment_size)
+    if segment_checksums is not None and len(segment_checksums) != segment_count:
+        raise ValueError(f"{segment_count} segments but {len(segment_checksums)} segment checksums")
+    if segment_checksums:
+        segment_checksums = [checksum.lower() for checksum in segment_checksums]
+
+    state = SegmentState(local_file, size, segment_size, segment_checksums)
+    address = urlparse(peers[rank])
+    server = SegmentServer((address.hostname, address.port), state)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    status_executor = ThreadPoolExecutor(max_workers=max(1, min(len(peers) - 1, max_status_workers)))
+    origin = OriginFetcher(urls, state, max_retries)
+
+    success = False
+    try:
+        own_segments = [segment for segment in state.missing()
+                        if get_owner(segment, segment_count, len(peers)) == rank]
+        logger.info(f"Fetching {len(own_segments)} of {segment_count} segments from origin.")
+        origin.add(own_segments)
+
+        started = time.monotonic()
+        last_seen = {peer: started for peer in range(len(peers)) if peer != rank}
+        statuses = {}
+        failures = {}
+        orphaned = {}
+        pulls = {}
+
+        while not state.complete():
+            if origin.failed:
+                logger.info("Origin fetch failed, giving up.")
+                return False
+
+            now = time.monotonic()
+            peer_statuses = status_executor.map(get_peer_status, [peers[peer] for peer in last_seen])
+            for peer, status in zip(last_seen, peer_statuses):
+                if status and status["size"] == size and status["segment_size"] == segment_size:
+                    statuses[peer] = status
+                    last_seen[peer] = now
+            alive = [peer for peer in last_seen if now - last_seen[peer] < peer_timeout]
+
+            for segment, pull in list(pulls.items()):
+                if pull.done():
+                    del pulls[segment]
+                    if not pull.result():
+                        failures[segment] = failures.get(segment, 0) + 1
+
+            orphans = []
+            for segment in state.missing():
+                if segment in pulls or segment in origin.queued:
+                    continue
+                sources = [peer for peer in alive if peer in statuses and statuses[peer]["have"][segment] == "1"]
+                if sources and failures.get(segment, 0) < max_peer_failures:
+                    if len(pulls) < max_workers:
+                        peer_url = peers[random.choice(sources)]
+                        pulls[segment] = executor.submit(pull_segment, peer_url, segment, state)
+                elif failures.get(segment, 0) >= max_peer_failures \
+                     or get_owner(segment, segment_count, len(peers)) not in alive:
+                    # Spread the missing share over whoever is left, fetch it ourselves
+                    # if the one it falls to doesn't deliver in time either
+                    orphaned_at = orphaned.setdefault(segment, now)
+                    participants = sorted(alive + [rank])
+                    if participants[segment % len(participants)] == rank or now - orphaned_at > peer_timeout:
+                        orphans.append(segment)
+            if orphans:
+                logger.info(f"Fetching {len(orphans)} unavailable segments from origin.")
+                origin.add(orphans)
+
+            time.sleep(poll_interval)
+
+        if expected_checksums:
+            checksums = hash_file(local_file, get_algorithms(expected_checksums))
+            if get_mismatches(expected_checksums, checksums):
+                logger.info(f"Checksum doesn't match. Calculated {checksums} Expecting: {expected_checksums}")
+                return False
+        success = True
+        logger.info(f"Cooperative download complete, {origin.bytes} of {size} bytes from origin.")
+
+        # Keep serving the others until they're done
+        linger_start = time.monotonic()
+        while time.monotonic() - linger_start < linger:
+            now = time.monotonic()
+            peer_statuses = status_executor.map(get_peer_status, [peers[peer] for peer in last_seen])
+            statuses = dict(zip(last_seen, peer_statuses))
+            for peer, status in statuses.items():
+                if status:
+                    last_seen[peer] = now
+            waiting = [peer for peer, status in statuses.items()
+                       if now - last_seen[peer] < peer_timeout and not (status and status["complete"])]
+            if not waiting:
+                break
+            time.sleep(poll_interval)
+
+    except KeyboardInterrupt as ex:
+        logger.info('SIGINT or CTRL-C detected, stopping.')
+        raise ex
+    except Exception as ex:
+        logger.info(f"Unexpected Error: {ex}")
+        success = False
+    finally:
+        origin.stop()
+        server.shutdown()
+        server.server_close()
+        executor.shutdown(wait=True)
+        status_executor.shutdown(wait=True)
+        state.close()
+        if success and os.path.exists(state.checkpoint):
+            os.remove(state.checkpoint)
+
+    return success
@@ -0,0 +1,262 @@
+import os
+import json
+import threading
+import posixpath
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse, quote, unquote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import best_download
+from best_download import download_file, get_file_metadata, session, set_connection_pool_size, stop_event
+from best_download.checksums import file_matches_checksum
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Records the validators of everything we have mirrored so later runs only
+# fetch new or changed entries. Lives in the root of local_directory.
+mirror_state_file_name = ".best_download_mirror.json"
+
+# Collects hrefs from an autoindex page (Apache, nginx, python http.server etc).
+class LinkParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag != "a":
+            return
+        for name, value in attrs:
+            if name == "href" and value:
+                self.links.append(value)
+
+# Directory urls need a trailing slash for urljoin to treat them as directories.
+def as_directory_url(url):
+    if not url.endswith("/"):
+        url += "/"
+    return url
+
+# Converts a url relative to the mirror root into a safe relative local path.
+# Returns None for anything that would escape local_directory.
+def safe_relative_path(relative_url):
+    path = posixpath.normpath(unquote(relative_url))
+    if path.startswith("/") or path == "." or path == ".." or path.startswith("../"):
+        return None
+    return path
+
+# Walks autoindex listings below url returning {relative_path: file_url}. Links
+# outside url (parent directory, other hosts, sort order query strings) are ignored.
+def list_directory(url, recursive=True):
+    root_url = as_directory_url(url)
+    entries = {}
+    pending = [root_url]
+    visited = set()
+    while pending:
+        directory_url = pending.pop()
+        if directory_url in visited:
+            continue
+        visited.add(directory_url)
+
+        response = session.get(directory_url, timeout=5)
+        response.raise_for_status()
+        parser = LinkParser()
+        parser.feed(response.text)
+
+        for link in parser.links:
+            link_url = urljoin(directory_url, link)
+            parsed = urlparse(link_url)
+            if parsed.query or parsed.fragment:
+                continue
+            link_url = parsed._replace(params="").geturl()
+            if not link_url.startswith(root_url) or link_url == root_url:
+                continue
+            if link_url.endswith("/"):
+                if recursive:
+                    pending.append(link_url)
+                continue
+
+            relative_path = safe_relative_path(link_url[len(root_url):])
+            if relative_path and relative_path != mirror_state_file_name:
+                entries[relative_path] = link_url
+
+    return entries
+
+# Manifest files have one entry per line, either a plain relative path or a json
+# object with "path" and optionally "url", "size" and "checksum" keys.
+def read_manifest(manifest, url):
+    root_url = as_directory_url(url)
+    entries = {}
+    with open(manifest, "r") as fh:
+        for line in fh:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+            else:
+                entry = {"path": line}
+
+            relative_path = safe_relative_path(entry["path"])
+            if not relative_path:
+                logger.info(f"Skipping unsafe manifest path '{entry['path']}'")
+                continue
+            entry["path"] = relative_path
+            if "url" not in entry:
+                entry["url"] = urljoin(root_url, quote(entry["path"]))
+            entries[relative_path] = entry
+
+    return entries
+
+class MirrorState():
+    def __init__(self, local_directory):
+        self.path = os.path.join(local_directory, mirror_state_file_name)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path, "r") as fh:
+                self.entries = json.load(fh)
+        except Exception:
+            self.entries = {}
+
+    def get(self, relative_path):
+        with self.lock:
+            return self.entries.get(relative_path)
+
+    def set(self, relative_path, entry):
+        with self.lock:
+            self.entries[relative_path] = entry
+            # Write then rename so an interrupted run never leaves a corrupt state file
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as fh:
+                json.dump(self.entries, fh)
+            os.replace(temp_path, self.path)
+
+# What we know about the remote copy of an entry, from the manifest and/or a HEAD request.
+def get_remote_info(entry):
+    remote = {"size": entry.get("size"), "etag": None, "last_modified": None,
+              "checksum": entry.get("checksum")}
+    # A manifest checksum is authoritative, no need to ask the server
+    if remote["checksum"]:
+        return remote
+
+    # Always ask the server, change detection can't use stale cached validators
+    metadata = get_file_metadata(entry["url"], use_cache=False)
+    if metadata:
+        if remote["size"] is None:
+            remote["size"] = metadata["content_length"]
+        remote["etag"] = metadata["etag"]
+        remote["last_modified"] = metadata["last_modified"]
+    return remote
+
+def same_remote_version(remote, recorded):
+    for key in ["size", "etag", "last_modified", "checksum"]:
+        if remote[key] is not None and remote[key] != recorded.get(key):
+            return False
+    return True
+
+def is_up_to_date(local_file, remote, recorded):
+    if not os.path.exists(local_file) or os.path.exists(local_file + ".ckpnt"):
+        return False
+
+    local_size = os.path.getsize(local_file)
+    if remote["size"] is not None and remote["size"] != local_size:
+        return False
+
+    if recorded and recorded.get("complete"):
+        # Local file untouched since we last downloaded it and remote unchanged
+        if recorded["local_size"] == local_size and recorded["local_mtime"] == os.path.getmtime(local_file) \
+           and same_remote_version(remote, recorded):
+            return True
+        if remote["etag"] is not None and recorded.get("etag") is not None and remote["etag"] != recorded["etag"]:
+            return False
+
+    if remote["checksum"]:
+        return file_matches_checksum(local_file, remote["checksum"], best_download.chunk_size)
+
+    if remote["last_modified"] is not None:
+        return os.path.getmtime(local_file) == remote["last_modified"]
+
+    # Nothing else to go on, trust a size match
+    return remote["size"] is not None
+
+def mirror_entry(entry, local_directory, state, max_retries):
+    relative_path = entry["path"]
+    local_file = os.path.join(local_directory, relative_path)
+    download_checkpoint = local_file + ".ckpnt"
+
+    remote = get_remote_info(entry)
+    recorded = state.get(relative_path)
+    if is_up_to_date(local_file, remote, recorded):
+        logger.info(f"Up to date: {relative_path}")
+        return "skipped"
+
+    # Only resume a partial download if it was started against the same remote version
+    if os.path.exists(download_checkpoint) and not (recorded and same_remote_version(remote, recorded)):
+        logger.info(f"Remote changed since partial download started, restarting: {relative_path}")
+        os.remove(download_checkpoint)
+
+    pending = dict(remote)
+    pending["complete"] = False
+    state.set(relative_path, pending)
+
+    os.makedirs(os.path.dirname(local_file) or ".", exist_ok=True)
+    if not download_file(entry["url"], expected_checksum=remote["checksum"], local_file=local_file,
+                         max_retries=max_retries):
+        return "failed"
+
+    # Match the remote mtime so later runs can compare against Last-Modified
+    if remote["last_modified"] is not None:
+        os.utime(local_file, (remote["last_modified"], remote["last_modified"]))
+
+    complete = dict(remote)
+    complete["complete"] = True
+    complete["local_size"] = os.path.getsize(local_file)
+    complete["local_mtime"] = os.path.getmtime(local_file)
+    state.set(relative_path, complete)
+    return "downloaded"
+
+# Mirrors everything below url into local_directory, either by walking autoindex
+# listings or from a manifest file (see read_manifest). Entries are compared against
+# local files using size, mtime, ETag or checksum and only new or changed entries
+# are downloaded. Partial downloads resume through the usual checkpoint files.
+# Returns a dict of relative path -> "downloaded", "skipped" or "failed".
+def mirror_directory(url, local_directory, manifest=None, recursive=True, max_workers=4,
+                     max_retries=3):
+
+    os.makedirs(local_directory, exist_ok=True)
+    if manifest:
+        entries = read_manifest(manifest, url)
+    else:
+        entries = {path: {"path": path, "url": file_url}
+                   for path, file_url in list_directory(url, recursive).items()}
+    logger.info(f"Mirroring {len(entries)} entries from {url} to {local_directory}")
+
+    if max_workers > 10:
+        set_connection_pool_size(max_workers)
+
+    state = MirrorState(local_directory)
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    futures = {executor.submit(mirror_entry, entry, local_directory, state, max_retries): path
+               for path, entry in entries.items()}
+    try:
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                results[path] = future.result()
+            except Exception as ex:
+                logger.info(f"Unexpected Error mirroring '{path}': {ex}")
+                results[path] = "failed"
+    except KeyboardInterrupt as ex:
+        logger.info('SIGINT or CTRL-C detected, stopping active downloads.')
+        for future in futures:
+            future.cancel()
+        stop_event.set()
+        executor.shutdown(wait=True)
+        stop_event.clear()
+        raise ex
+    finally:
+        executor.shutdown(wait=False)
+
+    failed = [path for path, result in results.items() if result == "failed"]
+    logger.info(f"Mirror complete. {len(results) - len(failed)} ok, {len(failed)} failed.")
+    return results
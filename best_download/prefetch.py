@@ -0,0 +1,252 @@
+import os
+import math
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from best_download import download_file, get_local_file, get_file_info_from_server
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Weight of the newest measurement in the download/consume time averages.
+smoothing = 0.3
+
+def update_average(average, value):
+    if average is None:
+        return value
+    return smoothing * value + (1 - smoothing) * average
+
+# Shards are a url (or list of failover urls) or a dict with "url" and optional
+# "checksum", "local_file" and "size" keys.
+def parse_shard(shard, local_directory):
+    if not isinstance(shard, dict):
+        shard = {"url": shard}
+    urls = shard["url"] if isinstance(shard["url"], list) else [shard["url"]]
+    return {
+        "urls": urls,
+        "checksum": shard.get("checksum"),
+        "local_file": get_local_file(urls[0], shard.get("local_file"), local_directory),
+        "size": shard.get("size"),
+        "state": "pending",
+        "future": None,
+    }
+
+# Downloads an ordered list of shards in the background, staying ahead of the
+# consumer, and hands out verified local paths in order:
+#
+#   with Prefetcher(urls, "cache/", max_ahead=8, disk_budget=50*10**9) as prefetcher:
+#       for local_file in prefetcher:
+#           train_on(local_file)
+#
+# A shard counts as consumed when the next one is requested, consumed shards are
+# deleted (evict=False keeps them). Prefetching stops at whichever limit comes first:
+# the prefetch depth in shards, max_bytes_ahead bytes downloaded but not yet handed
+# out, or disk_budget bytes on disk in total. The shard the consumer is waiting for
+# is always fetched even if it breaks a byte limit on its own.
+# With auto_tune the depth follows the measured time per shard download vs time the
+# consumer spends per shard (never more than max_ahead), otherwise it is max_ahead.
+# Sizes for the byte limits come from the shard dicts or, only when a byte limit is
+# set, a HEAD request.
+# A shard that fails all retries raises RuntimeError when it is reached.
+class Prefetcher():
+    def __init__(self, shards, local_directory=None, max_ahead=8, max_bytes_ahead=None, disk_budget=None,
+                 max_workers=2, max_retries=3, evict=True, auto_tune=True, use_head=True):
+        self.shards = [parse_shard(shard, local_directory) for shard in shards]
+        self.max_ahead = max_ahead or len(self.shards)
+        self.max_bytes_ahead = max_bytes_ahead
+        self.disk_budget = disk_budget
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.evict = evict
+        self.auto_tune = auto_tune
+        self.use_head = use_head
+        if local_directory:
+            os.makedirs(local_directory, exist_ok=True)
+
+        self.depth = min(self.max_ahead, max_workers) if auto_tune else self.max_ahead
+        self.download_seconds = None # Average wall time per shard download
+        self.consume_seconds = None  # Average time the consumer spends per shard
+        self.stall_seconds = 0       # Total time the consumer waited on downloads
+
+        self.position = 0      # Next shard to hand out
+        self.next_download = 0 # Next shard to start downloading
+        self.in_flight = 0
+        self.kept_bytes = 0    # Handed out shards still on disk
+        self.current = None
+        self.handed_out_at = None
+        self.closed = False
+        self.cancel_event = threading.Event() # Stops running downloads on close
+        self.condition = threading.Condition(threading.RLock())
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __len__(self):
+        return len(self.shards)
+
+    def __iter__(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # HEAD for a shard size, called without the lock held. A failed lookup counts as 0.
+    def get_size(self, shard):
+        _, size = get_file_info_from_server(shard["urls"][0])
+        shard["size"] = size or 0
+
+    # Downloaded (or downloading) but not yet handed out
+    def bytes_ahead(self):
+        return sum(shard["size"] or 0 for shard in self.shards[self.position:self.next_download])
+
+    def retune(self):
+        if not self.auto_tune or self.download_seconds is None or self.consume_seconds is None:
+            return
+        depth = math.ceil(self.download_seconds / max(self.consume_seconds, 1e-3)) + 1
+        depth = max(1, min(depth, self.max_ahead))
+        if depth != self.depth:
+            logger.info(f"Prefetch depth {self.depth} -> {depth}")
+            self.depth = depth
+
+    # Starts as many downloads as the limits allow. Must be called without the lock
+    # held, shard sizes are only looked up (HEAD) when a byte limit is set and outside
+    # the lock.
+    def fill(self):
+        while True:
+            with self.condition:
+                shard = self.start_downloads()
+            if shard is None:
+                return
+            self.get_size(shard)
+
+    # Called with the lock held. Returns a shard whose size is needed before going on,
+    # or None once every download the limits allow has been started.
+    def start_downloads(self):
+        byte_limits = self.max_bytes_ahead or self.disk_budget
+        while not self.closed and self.next_download < len(self.shards) \
+              and self.in_flight < self.max_workers:
+            index = self.next_download
+            shard = self.shards[index]
+            if index > self.position:
+                if index - self.position >= self.depth:
+                    break
+                if byte_limits:
+                    for ahead in self.shards[self.position:index + 1]:
+                        if ahead["size"] is None:
+                            return ahead
+                    bytes_ahead = self.bytes_ahead()
+                    if self.max_bytes_ahead and bytes_ahead + shard["size"] > self.max_bytes_ahead:
+                        break
+                    if self.disk_budget and self.kept_bytes + bytes_ahead + shard["size"] > self.disk_budget:
+                        break
+
+            shard["state"] = "downloading"
+            self.in_flight += 1
+            self.next_download += 1
+            shard["future"] = self.executor.submit(self.download, shard)
+        return None
+
+    def download(self, shard):
+        start = time.perf_counter()
+        try:
+            success = download_file(shard["urls"], expected_checksum=shard["checksum"],
+                                    local_file=shard["local_file"], max_retries=self.max_retries,
+                                    use_head=self.use_head, cancel_event=self.cancel_event)
+        except KeyboardInterrupt:
+            # Stopped by close, only a checkpointed partial download is worth keeping
+            if not os.path.exists(shard["local_file"] + ".ckpnt"):
+                self.remove(shard)
+            success = None
+        except Exception as ex:
+            logger.info(f"Unexpected Error: {ex}")
+            success = False
+        seconds = time.perf_counter() - start
+
+        with self.condition:
+            self.in_flight -= 1
+            if success is None:
+                shard["state"] = "pending"
+            elif success:
+                shard["state"] = "done"
+                shard["size"] = os.path.getsize(shard["local_file"])
+                self.download_seconds = update_average(self.download_seconds, seconds)
+                self.retune()
+            else:
+                shard["state"] = "failed"
+            self.condition.notify_all()
+        self.fill()
+
+    def remove(self, shard):
+        if os.path.exists(shard["local_file"]):
+            os.remove(shard["local_file"])
+
+    def release_current(self):
+        if self.current is None:
+            return
+        shard = self.shards[self.current]
+        shard["state"] = "consumed"
+        if self.evict:
+            self.remove(shard)
+            self.kept_bytes -= shard["size"] or 0
+        self.current = None
+
+    def __next__(self):
+        now = time.perf_counter()
+        with self.condition:
+            if self.closed:
+                raise StopIteration
+            if self.current is not None:
+                self.consume_seconds = update_average(self.consume_seconds, now - self.handed_out_at)
+                self.retune()
+                self.release_current()
+
+            finished = self.position >= len(self.shards)
+
+        # Outside the lock, close waits on the download threads and fill may HEAD
+        if finished:
+            self.close()
+            raise StopIteration
+        self.fill()
+        with self.condition:
+            local_file = self.hand_out(now)
+        self.fill()
+        return local_file
+
+    # Called with the lock held, waits for the next shard and hands it out.
+    def hand_out(self, now):
+        shard = self.shards[self.position]
+        while shard["state"] not in ["done", "failed"]:
+            self.condition.wait()
+        self.stall_seconds += time.perf_counter() - now
+
+        if shard["state"] == "failed":
+            raise RuntimeError(f"Failed downloading shard '{shard['urls'][0]}'")
+
+        self.current = self.position
+        self.position += 1
+        self.kept_bytes += shard["size"] or 0
+        self.handed_out_at = time.perf_counter()
+        return shard["local_file"]
+
+    # Stops prefetching, interrupts downloads already running (within a chunk, their
+    # checkpoints are kept) and with evict removes everything completed but not yet
+    # consumed.
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.cancel_event.set()
+            for shard in self.shards:
+                if shard["future"] and shard["future"].cancel():
+                    shard["state"] = "pending"
+        self.executor.shutdown(wait=True)
+
+        with self.condition:
+            self.release_current()
+            if self.evict:
+                for shard in self.shards:
+                    if shard["state"] == "done":
+                        self.remove(shard)
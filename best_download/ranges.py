@@ -0,0 +1,321 @@
+import re
+import time
+import bisect
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import best_download
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Ranges closer than this are requested as one span and the gap thrown away, a new
+# part costs ~100 bytes of multipart headers plus the parsing.
+default_max_gap = 64*1024
+# Spans per multi-range request, keeps the Range header well under the 8KB most
+# servers accept.
+default_max_ranges = 64
+
+# One requested range and where its bytes go: a memoryview over a buffer or an offset
+# into the output file.
+class RangeTarget():
+    def __init__(self, start, length, destination):
+        self.start = start
+        self.end = start + length
+        self.destination = destination
+        self.received = 0
+
+    def write(self, data, offset, file_writer):
+        if isinstance(self.destination, memoryview):
+            self.destination[offset:offset + len(data)] = data
+        else:
+            file_writer.write(self.destination + offset, data)
+        self.received += len(data)
+
+# Contiguous byte span [start, end) covering one or more nearby targets.
+class Span():
+    def __init__(self, target):
+        self.start = target.start
+        self.end = target.end
+        self.targets = [target]
+
+    def add(self, target):
+        self.end = max(self.end, target.end)
+        self.targets.append(target)
+
+    def reset(self):
+        for target in self.targets:
+            target.received = 0
+
+    def complete(self):
+        return all(target.received >= target.end - target.start for target in self.targets)
+
+class FileWriter():
+    def __init__(self, file_out):
+        self.file_out = file_out
+        self.lock = threading.Lock()
+
+    def write(self, offset, data):
+        with self.lock:
+            self.file_out.seek(offset)
+            self.file_out.write(data)
+
+# Hands data at an absolute offset of the remote file to every target it overlaps.
+class SpanDispatcher():
+    def __init__(self, spans, file_writer):
+        self.spans = spans
+        self.starts = [span.start for span in spans]
+        self.file_writer = file_writer
+
+    def write(self, position, data):
+        end = position + len(data)
+        index = max(bisect.bisect_right(self.starts, position) - 1, 0)
+        while index < len(self.spans) and self.spans[index].start < end:
+            for target in self.spans[index].targets:
+                low = max(target.start, position)
+                high = min(target.end, end)
+                if low < high:
+                    target.write(data[low - position:high - position], low - target.start, self.file_writer)
+            index += 1
+
+# Incremental multipart/byteranges parser. Part lengths come from each part's
+# Content-Range so the bodies are never scanned for the boundary.
+class MultipartReader():
+    def __init__(self, boundary, write):
+        self.delimiter = b"--" + boundary.encode("latin-1")
+        self.write = write
+        self.buffer = bytearray()
+        self.position = 0
+        self.remaining = 0
+        self.finished = False
+
+    def feed(self, chunk):
+        view = memoryview(chunk)
+        while len(view) and not self.finished:
+            if self.remaining:
+                size = min(self.remaining, len(view))
+                self.write(self.position, view[:size])
+                self.position += size
+                self.remaining -= size
+                view = view[size:]
+            else:
+                self.buffer += view
+                view = self.read_headers()
+
+    # Looks for the next delimiter and part headers in the buffer, returns whatever
+    # follows them (the start of the part body) or an empty view if more is needed.
+    def read_headers(self):
+        index = self.buffer.find(self.delimiter)
+        if index < 0:
+            return memoryview(b"")
+        after = index + len(self.delimiter)
+        if len(self.buffer) < after + 2:
+            return memoryview(b"")
+        if self.buffer[after:after + 2] == b"--":
+            self.finished = True
+            return memoryview(b"")
+
+        headers_end = self.buffer.find(b"\r\n\r\n", after)
+        if headers_end < 0:
+            if len(self.buffer) > 64*1024:
+                raise ValueError("Multipart part headers too long")
+            return memoryview(b"")
+
+        headers = self.buffer[after:headers_end].decode("latin-1")
+        match = re.search(r"^content-range:\s*bytes (\d+)-(\d+)/(\d+|\*)\s*$", headers, re.I | re.M)
+        if not match:
+            raise ValueError(f"Multipart part without Content-Range: {headers.strip()}")
+        self.position = int(match.group(1))
+        self.remaining = int(match.group(2)) - self.position + 1
+
+        rest = bytes(self.buffer[headers_end + 4:])
+        self.buffer = bytearray()
+        return memoryview(rest)
+
+# Sorts targets and merges those within max_gap bytes of each other into spans.
+def coalesce(targets, max_gap):
+    spans = []
+    for target in sorted(targets, key=lambda target: target.start):
+        if spans and target.start <= spans[-1].end + max_gap:
+            spans[-1].add(target)
+        else:
+            spans.append(Span(target))
+    return spans
+
+# Server behaviour learned from a range request
+honours_multiple = "multiple"
+honours_single = "single"
+ignores_ranges = "ignored"
+
+# One GET for spans. Returns honours_single if the server answered a multi-range
+# request with a single part, ignores_ranges for a full body (every one of all_spans
+# is then picked out of it in the same pass) and honours_multiple otherwise. Spans
+# left incomplete are picked up by the caller.
+def fetch_request(url, spans, file_writer, all_spans=None):
+    for span in spans:
+        span.reset()
+
+    headers = {"Accept-Encoding": "identity"} # Avoid dealing with gzip
+    headers["Range"] = "bytes=" + ",".join(f"{span.start}-{span.end - 1}" for span in spans)
+
+    dispatcher = SpanDispatcher(spans, file_writer)
+    with best_download.transport.get(url, headers=headers, timeout=5) as response:
+        response.raise_for_status()
+        content_type = response.headers.get("Content-Type", "")
+
+        if response.status_code == 206 and content_type.lower().startswith("multipart/byteranges"):
+            match = re.search(r'boundary="?([^";]+)"?', content_type, re.I)
+            if not match:
+                raise ValueError(f"No boundary in '{content_type}'")
+            reader = MultipartReader(match.group(1), dispatcher.write)
+            for chunk in response.iter_content(best_download.chunk_size):
+                reader.feed(chunk)
+                if reader.finished:
+                    break
+            return honours_multiple
+
+        if response.status_code == 206:
+            match = re.match(r"^bytes (\d+)-(\d+)/", response.headers.get("Content-Range", ""))
+            if not match:
+                raise ValueError(f"Unexpected Content-Range '{response.headers.get('Content-Range')}'")
+            position = int(match.group(1))
+        else:
+            # Ranges ignored, pick every span out of the full body and hang up after the last
+            logger.info("Server ignored Range, reading from the start of the file.")
+            position = 0
+            spans = all_spans or spans
+            for span in spans:
+                span.reset()
+            dispatcher = SpanDispatcher(spans, file_writer)
+
+        last = spans[-1].end
+        try:
+            for chunk in response.iter_content(best_download.chunk_size):
+                dispatcher.write(position, memoryview(chunk))
+                position += len(chunk)
+                if position >= last:
+                    break
+        except Exception as ex:
+            if response.status_code == 206:
+                raise ex
+            # Still a full body, the next attempt reads it again in one pass
+            logger.info(f"Range request error: {ex}")
+
+        if response.status_code != 206:
+            return ignores_ranges
+        if len(spans) == 1 or all(span.complete() for span in spans):
+            return honours_multiple
+        return honours_single
+
+def try_fetch_request(url, spans, file_writer, all_spans=None):
+    try:
+        return fetch_request(url, spans, file_writer, all_spans)
+    except KeyboardInterrupt as ex:
+        raise ex
+    except Exception as ex:
+        logger.info(f"Range request error: {ex}")
+        return honours_multiple
+
+# One attempt at every span from url. The first request finds out whether the server
+# takes multiple ranges, the rest go out concurrently either as multi-range requests
+# or, for servers that only honour single ranges, one request per span. A server
+# ignoring ranges had every span read from the first response, re-streaming the body
+# for each group would only repeat that. Returns the spans still incomplete.
+def fetch_spans(url, spans, max_ranges, max_workers, file_writer):
+    groups = [spans[i:i + max_ranges] for i in range(0, len(spans), max_ranges)]
+    behaviour = try_fetch_request(url, groups[0], file_writer, spans)
+    if behaviour == ignores_ranges:
+        remaining = []
+    elif behaviour == honours_multiple:
+        remaining = groups[1:]
+    else:
+        logger.info("Server only honours single ranges, falling back to one request per span.")
+        remaining = [[span] for span in spans if not span.complete()]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda group: try_fetch_request(url, group, file_writer), remaining))
+
+    return [span for span in spans if not span.complete()]
+
+# Fetches many byte ranges of one remote file with as few requests as possible. Nearby
+# ranges are coalesced and sent together as "Range: bytes=a-b,c-d,..." with the
+# multipart/byteranges response parsed as it streams. Servers that only honour single
+# ranges get a pooled set of single-range requests instead (max_workers at a time).
+# ranges is a list of (start, length). destinations optionally gives, for each range,
+# a writable buffer (bytearray, mmap, numpy array...) or an offset into local_file.
+# Without destinations each range goes into a new bytearray, or with local_file to the
+# same offset it has in the remote file (for repairing blocks in place). local_file is
+# created if missing, never truncated. urls and max_retries work as in download_file.
+# Returns the list of destinations on success, None on failure.
+def fetch_ranges(urls, ranges, local_file=None, destinations=None, max_gap=default_max_gap,
+                 max_ranges=default_max_ranges, max_workers=4, max_retries=3):
+
+    if not isinstance(urls, list):
+        urls = [urls]
+
+    if destinations is None:
+        if local_file:
+            destinations = [start for start, _ in ranges]
+        else:
+            destinations = [bytearray(length) for _, length in ranges]
+    if len(destinations) != len(ranges):
+        raise ValueError(f"{len(ranges)} ranges but {len(destinations)} destinations")
+
+    targets = []
+    for (start, length), destination in zip(ranges, destinations):
+        if start < 0 or length < 0:
+            raise ValueError(f"Invalid range ({start}, {length})")
+        if isinstance(destination, int):
+            if not local_file:
+                raise ValueError("File offset destination without local_file")
+        else:
+            destination = memoryview(destination).cast("B")
+            if destination.nbytes < length:
+                raise ValueError(f"Buffer of {destination.nbytes} bytes too small for {length} bytes")
+        if length:
+            targets.append(RangeTarget(start, length, destination))
+
+    spans = coalesce(targets, max_gap)
+    logger.info(f"{len(targets)} ranges coalesced into {len(spans)} spans")
+
+    file_out = None
+    success = not spans
+    try:
+        if local_file and any(isinstance(target.destination, int) for target in targets):
+            if not Path(local_file).exists():
+                Path(local_file).touch()
+            file_out = open(local_file, "r+b")
+        file_writer = FileWriter(file_out)
+
+        for url in urls:
+            if success:
+                break
+            pending = spans
+            for i in range(max_retries):
+                logger.info(f"Range fetch attempt {i+1}, {len(pending)} spans")
+                pending = fetch_spans(url, pending, max_ranges, max_workers, file_writer)
+                if not pending:
+                    success = True
+                    break
+                time.sleep(1)
+
+            if not success:
+                logger.info(f"Failed fetching ranges from url '{url}'")
+
+    except KeyboardInterrupt as ex:
+        logger.info('SIGINT or CTRL-C detected, stopping.')
+        raise ex
+    except Exception as ex:
+        logger.info(f"Unexpected Error: {ex}")
+        success = False
+    finally:
+        if file_out:
+            file_out.close()
+        for target in targets:
+            if isinstance(target.destination, memoryview):
+                target.destination.release()
+
+    if success:
+        return destinations
+    return None
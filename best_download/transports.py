@@ -0,0 +1,113 @@
+import time
+import random
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Transports make the HEAD and streamed GET requests for the download functions.
+# head() returns a response, get() a streamed response usable as a context manager.
+# Responses need status_code, headers (case insensitive), raise_for_status(),
+# iter_content(chunk_size) and close(), as requests.Response has.
+# Install one with best_download.set_transport.
+
+retry_statuses = [429, 500, 502, 503, 504]
+
+# HTTP/1.1 through a requests session, the default. Connection pooling and retries
+# come from the session's adapter. HEAD requests go through head_session when given,
+# one without retries as HEAD failures only mean falling back to a plain GET.
+class RequestsTransport():
+    def __init__(self, session, head_session=None):
+        self.session = session
+        self.head_session = head_session or session
+
+    def head(self, url, headers=None, timeout=5):
+        return self.head_session.head(url, headers=headers, allow_redirects=True, timeout=timeout)
+
+    def get(self, url, headers=None, timeout=5):
+        return self.session.get(url, headers=headers, stream=True, timeout=timeout)
+
+# Gives an httpx response the parts of the requests.Response interface we use.
+class HTTPXResponse():
+    def __init__(self, response):
+        self.response = response
+
+    @property
+    def status_code(self):
+        return self.response.status_code
+
+    @property
+    def headers(self):
+        return self.response.headers
+
+    def raise_for_status(self):
+        self.response.raise_for_status()
+
+    def iter_content(self, chunk_size):
+        return self.response.iter_bytes(chunk_size)
+
+    def close(self):
+        self.response.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# HTTP/2 through httpx (pip install best-download[http2]). Concurrent requests from
+# any number of threads are multiplexed as streams over at most max_connections
+# connections per host. Over https HTTP/2 is negotiated and servers without it get
+# HTTP/1.1, where requests queue for one of the max_connections connections, so size
+# it to the number of threads. prior_knowledge=True speaks HTTP/2 straight away over
+# plain http (h2c).
+# Connection errors and 429/5xx answers to GET are retried like the requests session
+# does, with jitter so streams dropped together don't all come back at once. HEAD is
+# not retried, see head_session in __init__.py.
+class HTTP2Transport():
+    def __init__(self, max_connections=4, retries=3, backoff_factor=1, prior_knowledge=False, verify=True):
+        if httpx is None:
+            raise ImportError("The HTTP/2 transport needs httpx, pip install best-download[http2]")
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.client = httpx.Client(http1=not prior_knowledge, http2=True, limits=limits, verify=verify,
+                                   follow_redirects=True)
+
+    def request(self, method, url, headers, timeout, retries):
+        for attempt in range(retries + 1):
+            backoff = round(self.backoff_factor * (2 ** attempt) * random.uniform(0.5, 1), 2)
+            try:
+                # No pool timeout, waiting for a connection (HTTP/1.1 servers take one
+                # request per connection) isn't a failure
+                request = self.client.build_request(method, url, headers=headers,
+                                                    timeout=httpx.Timeout(timeout, pool=None))
+                response = self.client.send(request, stream=True)
+            except httpx.TransportError as ex:
+                if attempt == retries:
+                    raise ex
+                logger.info(f"{method} {url} failed ({ex}), retrying in {backoff}s")
+                time.sleep(backoff)
+                continue
+
+            if response.status_code in retry_statuses and attempt < retries:
+                response.close()
+                logger.info(f"{method} {url} returned {response.status_code}, retrying in {backoff}s")
+                time.sleep(backoff)
+                continue
+            return HTTPXResponse(response)
+
+    def head(self, url, headers=None, timeout=5):
+        response = self.request("HEAD", url, headers, timeout, 0)
+        response.close()
+        return response
+
+    def get(self, url, headers=None, timeout=5):
+        return self.request("GET", url, headers, timeout, self.retries)
+
+    def close(self):
+        self.client.close()
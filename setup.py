@@ -14,6 +14,12 @@ with io_open(requirements_dev, mode='r') as fd:
     extras_require['dev'] = [i.strip().split('#', 1)[0].strip()
                              for i in fd.read().strip().split('\n')]
 
+# Optional fast non-cryptographic checksums (xxh64, xxh3_64, xxh128, crc32c)
+extras_require['fast_hash'] = ['xxhash', 'crc32c']
+
+# Optional HTTP/2 transport (best_download.set_transport("http2"))
+extras_require['http2'] = ['httpx[http2]']
+
 
 install_requires = ["requests", "tqdm"]
 
@@ -36,5 +42,9 @@ setuptools.setup(
     extras_require=extras_require,
     install_requires=install_requires,
     packages=['best_download'],
+    entry_points={
+        'console_scripts': ['best-download=best_download.cli:main',
+                            'best-download-cache=best_download.cache_server:main'],
+    },
     package_data={'best_download': ['LICENCE', 'examples/*.py','requirements-dev.txt']},
 )
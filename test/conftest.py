@@ -0,0 +1,62 @@
+from benchmarks.faulty_server import FaultyHandler
+import socket
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+
+# ================ SUPPORT ================ #
+# FaultyHandler recording (method, path, Range header) of every request, aliased paths
+# are then rewritten so a test can change the remote file behind a url
+class RecordingHandler(FaultyHandler):
+    def do_HEAD(self):
+        self.record("HEAD", None)
+        super().do_HEAD()
+
+    def do_GET(self):
+        self.record("GET", self.headers.get("Range"))
+        super().do_GET()
+
+    def record(self, method, byte_range):
+        self.server.requests.append((method, self.path, byte_range))
+        for alias, path in self.server.aliases.items():
+            self.path = self.path.replace(alias, path)
+
+class RecordingServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("localhost", 0), RecordingHandler)
+        self.url = f"http://localhost:{self.server_address[1]}"
+        self.requests = []
+        self.aliases = {}
+
+    def methods(self):
+        return [method for method, path, byte_range in self.requests]
+
+    # Range headers of the GETs, only those for path when given
+    def ranges(self, path=None):
+        return [byte_range for method, request_path, byte_range in self.requests
+                if method == "GET" and path in (None, request_path)]
+
+def get_free_ports(count):
+    sockets = [socket.socket() for _ in range(count)]
+    for sock in sockets:
+        sock.bind(("localhost", 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+# ================ Fixtures ================ #
+@pytest.fixture
+def faulty_server():
+    server = RecordingServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def free_ports():
+    return get_free_ports
@@ -255,6 +255,7 @@ class RunServer:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.p.terminate()
+        self.p.join() # Release the port before the next server starts
 
 
 # ================ Testception ================ #
@@ -575,4 +576,29 @@ def test_no_head(expected_checksum):
             url = "http://localhost:6001/no_head"
             assert download_file(url, expected_checksum=expected_checksum, local_file=test_file_name)
             assert os.path.exists(test_file_name)
-            os.remove(test_file_name)        
\ No newline at end of file
+            os.remove(test_file_name)
+
+
+# Same again without the HEAD request, learning everything from the first ranged GET
+def test_no_head_probe(expected_checksum):
+    logger.info(f"Expected Checksum: {expected_checksum}")
+
+    with RunServer(function=server_no_head) as s:
+        with RunServer(function=flask_server) as fs:
+            url = "http://localhost:6001/no_head"
+            assert download_file(url, expected_checksum=expected_checksum, local_file=test_file_name,
+                                 use_head=False)
+            assert os.path.exists(test_file_name)
+            assert not os.path.exists(test_file_name + ".ckpnt")
+            os.remove(test_file_name)
+
+
+def test_accept_ranges_probe(expected_checksum):
+    logger.info(f"Expected Checksum: {expected_checksum}")
+
+    with RunServer(function=server_accept_ranges) as fs:
+        url = "http://localhost:6001/100mb.test"
+        assert download_file(url, expected_checksum=expected_checksum, local_file=test_file_name,
+                             use_head=False)
+        assert os.path.exists(test_file_name)
+        os.remove(test_file_name)
@@ -0,0 +1,64 @@
+from best_download import download_into, download_bytes
+from benchmarks.faulty_server import get_data
+import mmap
+import uuid
+import hashlib
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+size = 3*1024*1024 + 5
+
+# Fresh fault counters for every url
+def data_url(server, query=""):
+    return f"{server.url}/data/{size}?run={uuid.uuid4().hex}&{query}"
+
+expected = bytes(get_data(size))
+expected_checksum = hashlib.sha256(expected).hexdigest()
+
+# ================ Tests ================ #
+def test_download_bytes(faulty_server):
+    data = download_bytes(data_url(faulty_server), expected_checksum=expected_checksum)
+    assert isinstance(data, bytearray)
+    assert data == expected
+
+    data, checksums = download_bytes(data_url(faulty_server), hash_algorithms=["md5"], return_checksums=True)
+    assert checksums == {"md5": hashlib.md5(expected).hexdigest()}
+
+    assert download_bytes(data_url(faulty_server), expected_checksum=hashlib.sha256(b"").hexdigest(),
+                          max_retries=1) is None
+
+def test_download_into(faulty_server, tmp_path):
+    buffer = bytearray(size + 100)
+    assert download_into(data_url(faulty_server), buffer, expected_checksum=expected_checksum) == size
+    assert buffer[:size] == expected
+
+    assert download_into(data_url(faulty_server), bytearray(size - 1), max_retries=1) is None
+
+    mapped_file = tmp_path / "mapped.bin"
+    mapped_file.write_bytes(b"\0" * size)
+    with open(mapped_file, "r+b") as fh, mmap.mmap(fh.fileno(), size) as mapped:
+        assert download_into(data_url(faulty_server), mapped) == size
+        mapped.flush()
+    assert mapped_file.read_bytes() == expected
+
+def test_download_bytes_resume(faulty_server):
+    # Disconnected half way, second attempt continues from the buffer
+    data = download_bytes(data_url(faulty_server, "disconnects=1"), expected_checksum=expected_checksum)
+    assert data == expected
+
+    # No range support so the second attempt starts again
+    data = download_bytes(data_url(faulty_server, "disconnects=1&ranges=0"), expected_checksum=expected_checksum)
+    assert data == expected
+
+def test_download_numpy(faulty_server):
+    numpy = pytest.importorskip("numpy")
+    data = download_bytes(data_url(faulty_server))
+    array = numpy.frombuffer(data, dtype=numpy.uint8)
+    assert array.nbytes == size
+
+    array = numpy.zeros(size, dtype=numpy.uint8)
+    assert download_into(data_url(faulty_server), array) == size
+    assert array.tobytes() == expected
@@ -0,0 +1,154 @@
+from best_download import download_file, cached_url
+from best_download.cache_server import CacheServer, parse_cached_path, main
+from benchmarks.faulty_server import get_data
+import os
+import time
+import uuid
+import hashlib
+from multiprocessing import Process, Value
+import requests
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+size = 8*1024*1024 + 3
+expected = bytes(get_data(size))
+expected_checksum = hashlib.sha256(expected).hexdigest()
+
+def run_cache(cache_directory, port):
+    CacheServer(cache_directory, port=port, max_retries=1).serve_forever()
+
+class RunCache:
+    def __init__(self, cache_directory, port):
+        self.cache_directory = cache_directory
+        self.port = port
+
+    def __enter__(self):
+        self.p = Process(target=run_cache, args=(self.cache_directory, self.port))
+        self.p.start()
+        url = f"http://localhost:{self.port}"
+        for _ in range(100):
+            try:
+                requests.get(url, timeout=1)
+                break
+            except requests.exceptions.RequestException:
+                time.sleep(0.1)
+        return url
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.p.terminate()
+        self.p.join()
+
+def origin_url(origin, query=""):
+    return f"{origin.url}/data/{size}?run={uuid.uuid4().hex}&{query}"
+
+def origin_requests(origin, url):
+    path = url[url.index("/data/"):]
+    return [(method, byte_range) for method, request_path, byte_range in origin.requests
+            if request_path == path]
+
+def do_download(urls, local_file, result):
+    result.value = download_file(urls, expected_checksum=expected_checksum, local_file=local_file)
+
+# ================ Tests ================ #
+def test_cached_url():
+    url = "https://example.com/data/shard.bin?token=abc"
+    cache_url = cached_url("http://localhost:6200/", url, "md5:ABCD")
+    assert cache_url == "http://localhost:6200/https/example.com/data/shard.bin?token=abc&bd_checksum=md5:ABCD"
+    assert parse_cached_path(cache_url[len("http://localhost:6200"):]) == (url, "md5:ABCD")
+    assert parse_cached_path("/ftp/example.com/x") is None
+
+def test_cache_open_proxy_refused(tmp_path):
+    cache_directory = str(tmp_path / "cache")
+    with pytest.raises(ValueError):
+        CacheServer(cache_directory, host="0.0.0.0", port=0)
+    with pytest.raises(SystemExit) as ex:
+        main([cache_directory, "--host", "0.0.0.0"])
+    assert ex.value.code == 2
+    CacheServer(cache_directory, host="127.0.0.1", port=0).server_close()
+    CacheServer(cache_directory, host="0.0.0.0", port=0, allowed_hosts=["localhost"]).server_close()
+
+def test_cache_shared_fill(faulty_server, free_ports, tmp_path):
+    # Throttled upstream so every client joins while the fill is running
+    url = origin_url(faulty_server, "bandwidth=8000000")
+    with RunCache(str(tmp_path / "cache"), free_ports(1)[0]) as cache:
+        urls = [cached_url(cache, url, expected_checksum), url]
+        clients = []
+        for i in range(4):
+            result = Value('i', -1)
+            client = Process(target=do_download, args=(urls, str(tmp_path / f"client_{i}.bin"), result))
+            client.start()
+            clients.append((client, result))
+        for client, result in clients:
+            client.join(timeout=60)
+            assert result.value == 1
+        for i in range(4):
+            assert (tmp_path / f"client_{i}.bin").read_bytes() == expected
+
+        # Upstream saw a single HEAD and GET for all four clients
+        assert origin_requests(faulty_server, url) == [("HEAD", None), ("GET", "bytes=0-")]
+
+        # Later requests are plain cache hits, with ranges
+        response = requests.get(urls[0], headers={"Range": "bytes=100-199"})
+        assert response.status_code == 206
+        assert response.headers["X-Cache"] == "hit"
+        assert response.headers["X-Checksum-Sha256"] == expected_checksum
+        assert response.content == expected[100:200]
+        assert requests.get(urls[0], headers={"Range": f"bytes={size}-"}).status_code == 416
+        assert len(origin_requests(faulty_server, url)) == 2
+
+def test_cache_range_while_filling(faulty_server, free_ports, tmp_path):
+    url = origin_url(faulty_server, "bandwidth=8000000")
+    with RunCache(str(tmp_path / "cache"), free_ports(1)[0]) as cache:
+        # Near the end of the object, waits for the fill to get there
+        response = requests.get(cached_url(cache, url), headers={"Range": "bytes=-1000"}, timeout=30)
+        assert response.status_code == 206
+        assert response.headers["X-Cache"] == "fill"
+        assert response.content == expected[-1000:]
+
+def test_cache_restart(faulty_server, free_ports, tmp_path):
+    cache_directory = str(tmp_path / "cache")
+    url = origin_url(faulty_server, "bandwidth=4000000")
+    port = free_ports(1)[0]
+    with RunCache(cache_directory, port) as cache:
+        requests.head(cached_url(cache, url)) # Starts the fill
+        time.sleep(1)
+
+    # Killed half way, the checkpoint is picked up by the next server
+    assert any(name.endswith(".ckpnt") for name in os.listdir(cache_directory))
+    with RunCache(cache_directory, port) as cache:
+        local_file = str(tmp_path / "client.bin")
+        assert download_file(cached_url(cache, url), expected_checksum=expected_checksum, local_file=local_file)
+        assert open(local_file, "rb").read() == expected
+
+    gets = [byte_range for method, byte_range in origin_requests(faulty_server, url) if method == "GET"]
+    assert len(gets) == 2
+    resume_point = int(gets[1][len("bytes="):-1])
+    assert 0 < resume_point < size
+
+def test_cache_checksum(faulty_server, free_ports, tmp_path):
+    url = origin_url(faulty_server)
+    local_file = str(tmp_path / "client.bin")
+    with RunCache(str(tmp_path / "cache"), free_ports(1)[0]) as cache:
+        # Fill fails verification, nothing is cached
+        wrong_checksum = hashlib.sha256(b"other").hexdigest()
+        assert not download_file(cached_url(cache, url, wrong_checksum), local_file=local_file,
+                                 expected_checksum=wrong_checksum, max_retries=1)
+        assert download_file(cached_url(cache, url, expected_checksum), local_file=local_file,
+                             expected_checksum=expected_checksum)
+        gets = len([method for method, _ in origin_requests(faulty_server, url) if method == "GET"])
+
+        # Other algorithms are computed from the cached copy
+        md5_checksum = f"md5:{hashlib.md5(expected).hexdigest()}"
+        assert download_file(cached_url(cache, url, md5_checksum), local_file=local_file,
+                             expected_checksum=md5_checksum)
+        assert len([method for method, _ in origin_requests(faulty_server, url) if method == "GET"]) == gets
+
+        # A checksum not matching the cached copy is refused, not fetched again
+        response = requests.get(cached_url(cache, url, wrong_checksum))
+        assert response.status_code == 409
+        assert len([method for method, _ in origin_requests(faulty_server, url) if method == "GET"]) == gets
+        assert download_file(cached_url(cache, url, expected_checksum), local_file=local_file,
+                             expected_checksum=expected_checksum)
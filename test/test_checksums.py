@@ -0,0 +1,84 @@
+from best_download import download_file
+from best_download.checksums import parse_expected_checksum, get_algorithms, hash_file, file_matches_checksum
+import os
+import zlib
+import hashlib
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+data = os.urandom(3*1024*1024 + 17)
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server_url(tmp_path):
+    remote_directory = tmp_path / "remote"
+    remote_directory.mkdir()
+    (remote_directory / "data.bin").write_bytes(data)
+
+    handler = functools.partial(QuietHandler, directory=str(remote_directory))
+    server = ThreadingHTTPServer(("localhost", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://localhost:{server.server_address[1]}/data.bin"
+    server.shutdown()
+    server.server_close()
+
+# ================ Tests ================ #
+def test_parse_expected_checksum():
+    assert parse_expected_checksum(None) == {}
+    assert parse_expected_checksum("ABCD") == {"sha256": "abcd"}
+    assert parse_expected_checksum("MD5:\"abcd\"") == {"md5": "abcd"}
+    assert parse_expected_checksum({"SHA-1": "ab", "blake2b": "cd"}) == {"sha1": "ab", "blake2b": "cd"}
+    with pytest.raises(ValueError):
+        parse_expected_checksum("nope:abcd")
+
+    assert get_algorithms({}) == ["sha256"]
+    assert get_algorithms({"md5": "ab"}, ["crc32", "md5"]) == ["md5", "crc32"]
+
+def test_hash_file(tmp_path):
+    local_file = tmp_path / "data.bin"
+    local_file.write_bytes(data)
+    checksums = hash_file(local_file, ["sha256", "md5", "crc32"], chunk_size=1000)
+    assert checksums == {
+        "sha256": hashlib.sha256(data).hexdigest(),
+        "md5": hashlib.md5(data).hexdigest(),
+        "crc32": f"{zlib.crc32(data):08x}",
+    }
+    assert file_matches_checksum(local_file, f"md5:{hashlib.md5(data).hexdigest()}")
+    assert not file_matches_checksum(local_file, hashlib.sha256(b"other").hexdigest())
+
+def test_xxhash(tmp_path):
+    xxhash = pytest.importorskip("xxhash")
+    local_file = tmp_path / "data.bin"
+    local_file.write_bytes(data)
+    assert hash_file(local_file, ["xxh3-64"]) == {"xxh3_64": xxhash.xxh3_64(data).hexdigest()}
+
+def test_download_multiple_digests(server_url, tmp_path):
+    local_file = str(tmp_path / "data.bin")
+    expected = {
+        "md5": hashlib.md5(data).hexdigest(),
+        "sha1": hashlib.sha1(data).hexdigest(),
+        "crc32": f"{zlib.crc32(data):08x}",
+    }
+    checksums = download_file(server_url, expected_checksum=expected, local_file=local_file,
+                              hash_algorithms=["blake2b"], return_checksums=True)
+    assert checksums == dict(expected, blake2b=hashlib.blake2b(data).hexdigest())
+
+    # Plain sha256 still works and the default return is a bool
+    assert download_file(server_url, expected_checksum=hashlib.sha256(data).hexdigest(), local_file=local_file) is True
+
+    expected["md5"] = hashlib.md5(b"other").hexdigest()
+    assert download_file(server_url, expected_checksum=expected, local_file=local_file, max_retries=1,
+                         return_checksums=True) is None
+
+    with pytest.raises(ValueError):
+        download_file(server_url, expected_checksum="nope:abcd", local_file=local_file)
@@ -0,0 +1,126 @@
+from best_download.cli import main
+import io
+import os
+import time
+import uuid
+import signal
+import sys
+import json
+import hashlib
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+remote_files = {"one.bin": os.urandom(20000), "two.bin": os.urandom(30000), "three.bin": os.urandom(10)}
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server_url(tmp_path):
+    remote_directory = tmp_path / "remote"
+    remote_directory.mkdir()
+    for path, data in remote_files.items():
+        (remote_directory / path).write_bytes(data)
+
+    handler = functools.partial(QuietHandler, directory=str(remote_directory))
+    server = ThreadingHTTPServer(("localhost", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://localhost:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+# ================ Tests ================ #
+def test_cli_input_file(server_url, tmp_path):
+    input_file = tmp_path / "urls.txt"
+    input_file.write_text(
+        "# comment\n"
+        f"{server_url}/one.bin {sha256(remote_files['one.bin'])}\n"
+        f"{server_url}/two.bin - renamed.bin\n"
+        f"{server_url}/three.bin\n")
+    local_directory = tmp_path / "local"
+    summary_path = tmp_path / "summary.json"
+
+    args = ["-i", str(input_file), "-d", str(local_directory), "-j", "3", "--summary", str(summary_path)]
+    assert main(args) == 0
+    with open(summary_path) as fh:
+        summary = json.load(fh)
+    assert summary["succeeded"] == 3
+    assert summary["failed"] == 0
+    assert [result["local_file"] for result in summary["files"]] == \
+        [str(local_directory / name) for name in ["one.bin", "renamed.bin", "three.bin"]]
+    assert summary["files"][1]["bytes"] == len(remote_files["two.bin"])
+    assert (local_directory / "renamed.bin").read_bytes() == remote_files["two.bin"]
+
+    # Completed files aren't downloaded again
+    assert main(args) == 0
+    with open(summary_path) as fh:
+        summary = json.load(fh)
+    assert summary["skipped"] == 3
+
+def test_cli_incomplete_not_skipped(server_url, faulty_server, tmp_path):
+    # Failed full download (no range support) leaves a truncated file without checkpoint
+    local_directory = tmp_path / "local"
+    url = f"{faulty_server.url}/data/3000000?ranges=0&disconnects=5&run={uuid.uuid4().hex}"
+    args = [url, "-d", str(local_directory), "--max-retries", "1", "--summary", str(tmp_path / "summary.json")]
+    assert main(args) == 1
+    assert 0 < os.path.getsize(local_directory / "3000000") < 3000000
+    assert main(args) == 1
+    with open(tmp_path / "summary.json") as fh:
+        summary = json.load(fh)
+    assert summary["skipped"] == 0
+
+    # Empty file left before the first checkpoint
+    (local_directory / "one.bin").touch()
+    assert main([f"{server_url}/one.bin", "-d", str(local_directory), "--summary", str(tmp_path / "summary.json")]) == 0
+    assert (local_directory / "one.bin").read_bytes() == remote_files["one.bin"]
+
+@pytest.mark.parametrize("query", ["head=0", "head=0&ranges=0"])
+def test_cli_no_head_skipped(faulty_server, tmp_path, query):
+    # The size check for completed files doesn't HEAD either
+    local_directory = tmp_path / "local"
+    url = f"{faulty_server.url}/data/100000?{query}&run={uuid.uuid4().hex}"
+    args = [url, "-d", str(local_directory), "--no-head", "--summary", str(tmp_path / "summary.json")]
+    assert main(args) == 0
+    assert main(args) == 0
+    with open(tmp_path / "summary.json") as fh:
+        summary = json.load(fh)
+    assert summary["skipped"] == 1
+    assert "HEAD" not in faulty_server.methods()
+
+def test_cli_interrupted(faulty_server, tmp_path, capsys):
+    # CTRL-C stops the downloads running in worker threads too, not only the queued ones
+    local_directory = tmp_path / "local"
+    urls = [f"{faulty_server.url}/data/{size}?bandwidth=1000000&run={uuid.uuid4().hex}" for size in [10000000, 10000001]]
+    timer = threading.Timer(1, os.kill, args=(os.getpid(), signal.SIGINT))
+    timer.start()
+    start = time.perf_counter()
+    assert main(urls + ["-d", str(local_directory), "-j", "2"]) == 130
+    assert time.perf_counter() - start < 5
+    assert os.path.getsize(local_directory / "10000000") < 10000000
+
+def test_cli_stdin_and_failures(server_url, tmp_path, monkeypatch, capsys):
+    local_directory = tmp_path / "local"
+    monkeypatch.setattr(sys, "stdin", io.StringIO(f"{server_url}/one.bin {sha256(b'wrong')}\n"))
+
+    assert main([f"{server_url}/two.bin", "-i", "-", "-d", str(local_directory), "--max-retries", "1"]) == 1
+    summary = json.loads(capsys.readouterr().out)
+    assert [result["success"] for result in summary["files"]] == [True, False]
+    assert summary["files"][0]["mb_per_second"] is not None
+
+def test_cli_usage_errors(tmp_path):
+    assert main([]) == 2
+    assert main(["-i", str(tmp_path / "missing.txt")]) == 2
+    with pytest.raises(SystemExit) as ex:
+        main(["--jobs", "0", "http://localhost/x"])
+    assert ex.value.code == 2
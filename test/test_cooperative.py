@@ -0,0 +1,98 @@
+from best_download import cooperative_download
+from best_download.cooperative import get_owner
+from benchmarks.faulty_server import get_data, parse_ranges
+import os
+import re
+import uuid
+import hashlib
+import threading
+from multiprocessing import Process, Value
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+size = 6*1024*1024 + 11
+segment_size = 256*1024
+expected = bytes(get_data(size))
+expected_checksum = hashlib.sha256(expected).hexdigest()
+segment_checksums = [hashlib.sha256(expected[i:i + segment_size]).hexdigest()
+                     for i in range(0, size, segment_size)]
+
+def origin_url(origin, query=""):
+    return f"{origin.url}/data/{size}?run={uuid.uuid4().hex}&{query}"
+
+def origin_bytes(origin):
+    return sum(end - start + 1 for header in origin.ranges() for start, end in parse_ranges(header, size))
+
+def do_download(url, local_file, peers, rank, result, kwargs):
+    result.value = cooperative_download(url, local_file, peers, rank, expected_checksum=expected_checksum,
+                                        segment_size=segment_size, peer_timeout=2, linger=10, **kwargs)
+
+def run_participants(url, tmp_path, peers, ranks, **kwargs):
+    participants = []
+    for rank in ranks:
+        result = Value('i', -1)
+        local_file = str(tmp_path / f"participant_{rank}.bin")
+        participant = Process(target=do_download, args=(url, local_file, peers, rank, result, kwargs))
+        participant.start()
+        participants.append((participant, result, local_file))
+    for participant, result, local_file in participants:
+        participant.join(timeout=120)
+        assert result.value == 1
+        assert open(local_file, "rb").read() == expected
+        assert not os.path.exists(local_file + ".segments")
+
+# Claims every segment and sends garbage
+class BadPeerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/segments":
+            body = (f'{{"size": {size}, "segment_size": {segment_size}, '
+                    f'"have": "{"1" * len(segment_checksums)}", "complete": true}}').encode()
+        else:
+            segment = int(re.match(r"^/segment/(\d+)$", self.path).group(1))
+            body = os.urandom(min(segment_size, size - segment * segment_size))
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Segment-Sha256", hashlib.sha256(body).hexdigest())
+        self.end_headers()
+        self.wfile.write(body)
+
+# ================ Tests ================ #
+def test_get_owner():
+    owners = [get_owner(segment, 10, 3) for segment in range(10)]
+    assert owners == sorted(owners)
+    assert set(owners) == {0, 1, 2}
+
+def test_cooperative_download(faulty_server, free_ports, tmp_path):
+    url = origin_url(faulty_server)
+    peers = [f"localhost:{port}" for port in free_ports(3)]
+    run_participants(url, tmp_path, peers, range(3))
+    # The origin served each byte once, the rest went between peers
+    assert origin_bytes(faulty_server) == size
+
+def test_cooperative_dead_peer(faulty_server, free_ports, tmp_path):
+    # Nobody runs rank 2, its share comes from the origin after peer_timeout
+    url = origin_url(faulty_server)
+    peers = [f"localhost:{port}" for port in free_ports(3)]
+    run_participants(url, tmp_path, peers, range(2))
+    assert size <= origin_bytes(faulty_server) < 2 * size
+
+def test_cooperative_bad_peer(faulty_server, free_ports, tmp_path):
+    bad_peer = ThreadingHTTPServer(("localhost", 0), BadPeerHandler)
+    bad_peer.daemon_threads = True
+    threading.Thread(target=bad_peer.serve_forever, daemon=True).start()
+    try:
+        url = origin_url(faulty_server)
+        peers = [f"localhost:{free_ports(1)[0]}", f"localhost:{bad_peer.server_address[1]}"]
+        run_participants(url, tmp_path, peers, [0], segment_checksums=segment_checksums)
+    finally:
+        bad_peer.shutdown()
+        bad_peer.server_close()
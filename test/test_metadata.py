@@ -0,0 +1,86 @@
+import best_download
+from best_download import download_file, get_file_metadata, parse_content_range
+from benchmarks.faulty_server import get_data
+import os
+import time
+import uuid
+import pickle
+import hashlib
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+size = 200000
+
+def data_url(server, query=""):
+    return f"{server.url}/data/{size}?run={uuid.uuid4().hex}&{query}"
+
+expected_checksum = hashlib.sha256(get_data(size)).hexdigest()
+
+# ================ Tests ================ #
+def test_parse_content_range():
+    assert parse_content_range("bytes 100-199/1000") == (100, 1000)
+    assert parse_content_range("bytes 0-0/*") == (0, None)
+    assert parse_content_range(None) is None
+    assert parse_content_range("bytes */1000") is None
+
+def test_metadata_cache(faulty_server, monkeypatch):
+    url = data_url(faulty_server)
+    assert get_file_metadata(url)["content_length"] == size
+    assert get_file_metadata(url)["accept_ranges"]
+    assert faulty_server.methods() == ["HEAD"]
+
+    monkeypatch.setattr(best_download, "metadata_cache_ttl", 0)
+    url = data_url(faulty_server)
+    get_file_metadata(url)
+    get_file_metadata(url)
+    assert faulty_server.methods() == ["HEAD"] * 3
+
+def test_metadata_head_rejected(faulty_server):
+    # No retry backoff for a server answering HEAD with 503, the download falls back
+    start = time.perf_counter()
+    assert get_file_metadata(data_url(faulty_server, "errors=10")) is None
+    assert time.perf_counter() - start < 1
+    assert faulty_server.methods() == ["HEAD"]
+
+def test_metadata_cache_remote_changed(faulty_server, tmp_path):
+    # Cached size from the first download is stale, retries and failover re-query it
+    local_file = str(tmp_path / "data.bin")
+    url = f"{faulty_server.url}/changing?run={uuid.uuid4().hex}"
+    faulty_server.aliases["/changing"] = "/data/1000"
+    assert download_file(url, expected_checksum=hashlib.sha256(get_data(1000)).hexdigest(), local_file=local_file)
+    faulty_server.aliases["/changing"] = "/data/2000"
+    assert download_file([url, url], expected_checksum=hashlib.sha256(get_data(2000)).hexdigest(),
+                         local_file=local_file)
+
+@pytest.mark.parametrize("query", ["", "ranges=0"])
+def test_probe_without_head(faulty_server, tmp_path, query):
+    local_file = str(tmp_path / "data.bin")
+    url = data_url(faulty_server, query)
+    assert download_file(url, expected_checksum=expected_checksum, local_file=local_file, use_head=False)
+    assert faulty_server.methods() == ["GET"]
+
+    # What the GET told us is cached
+    metadata = get_file_metadata(url)
+    assert metadata["content_length"] == size
+    assert metadata["accept_ranges"] == (query == "")
+    assert faulty_server.methods() == ["GET"]
+
+def test_probe_resume(faulty_server, tmp_path):
+    local_file = str(tmp_path / "data.bin")
+    url = data_url(faulty_server, "disconnects=1")
+    assert download_file(url, expected_checksum=expected_checksum, local_file=local_file, use_head=False)
+    assert faulty_server.methods() == ["GET", "GET"]
+
+def test_probe_complete_checkpoint(faulty_server, tmp_path):
+    # Cut off after the last chunk was written, the probe gets a 416 and just hashes
+    local_file = str(tmp_path / "data.bin")
+    with open(local_file, "wb") as fh:
+        fh.write(get_data(size))
+    with open(local_file + ".ckpnt", "wb") as fh:
+        pickle.dump(size, fh)
+    assert download_file(data_url(faulty_server), expected_checksum=expected_checksum, local_file=local_file,
+                         use_head=False)
+    assert not os.path.exists(local_file + ".ckpnt")
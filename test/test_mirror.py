@@ -0,0 +1,177 @@
+from best_download import mirror_directory
+from best_download.mirror import mirror_state_file_name
+import os
+import re
+import json
+import pickle
+import time
+import hashlib
+import threading
+import functools
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+remote_files = {
+    "a.bin": os.urandom(100000),
+    "b.bin": os.urandom(2000),
+    "nested/c.bin": os.urandom(50000),
+    "nested/deeper/d.bin": os.urandom(10),
+}
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+# http.server without ranges would never resume, add "bytes=<start>-" and record them
+class RangeHandler(QuietHandler):
+    ranges = []
+
+    def end_headers(self):
+        self.send_header("Accept-Ranges", "bytes")
+        super().end_headers()
+
+    def do_GET(self):
+        RangeHandler.ranges.append((self.path, self.headers.get("Range")))
+        match = re.match(r"^bytes=(\d+)-$", self.headers.get("Range", ""))
+        if not match:
+            return super().do_GET()
+        with open(self.translate_path(self.path), "rb") as fh:
+            data = fh.read()
+        start = int(match.group(1))
+        self.send_response(206)
+        self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+# http.server's directory listings are a perfectly normal autoindex
+@pytest.fixture
+def remote_directory(tmp_path):
+    remote_directory = tmp_path / "remote"
+    for path, data in remote_files.items():
+        remote_path = remote_directory / path
+        remote_path.parent.mkdir(parents=True, exist_ok=True)
+        remote_path.write_bytes(data)
+
+    RangeHandler.ranges = []
+    handler = functools.partial(RangeHandler, directory=str(remote_directory))
+    server = ThreadingHTTPServer(("localhost", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield remote_directory, f"http://localhost:{server.server_address[1]}/"
+    server.shutdown()
+    server.server_close()
+
+def read_local(local_directory, path):
+    with open(os.path.join(local_directory, path), "rb") as fh:
+        return fh.read()
+
+# ================ Tests ================ #
+def test_mirror_autoindex(remote_directory, tmp_path):
+    remote_path, url = remote_directory
+    local_directory = str(tmp_path / "local")
+
+    results = mirror_directory(url, local_directory)
+    assert results == {path: "downloaded" for path in remote_files}
+    for path, data in remote_files.items():
+        assert read_local(local_directory, path) == data
+
+    # Nothing changed
+    results = mirror_directory(url, local_directory)
+    assert results == {path: "skipped" for path in remote_files}
+
+    # Change one file upstream, only that one is fetched
+    new_data = os.urandom(3000)
+    (remote_path / "b.bin").write_bytes(new_data)
+    os.utime(remote_path / "b.bin", (time.time() + 10, time.time() + 10))
+    results = mirror_directory(url, local_directory)
+    assert results["b.bin"] == "downloaded"
+    assert [result for path, result in results.items() if path != "b.bin"] == ["skipped"] * 3
+    assert read_local(local_directory, "b.bin") == new_data
+
+# Leaves a.bin half downloaded with its checkpoint, as an interrupted run would
+def interrupt_download(local_directory):
+    local_file = os.path.join(local_directory, "a.bin")
+    state_file = os.path.join(local_directory, mirror_state_file_name)
+    with open(state_file) as fh:
+        state = json.load(fh)
+    state["a.bin"]["complete"] = False
+    with open(state_file, "w") as fh:
+        json.dump(state, fh)
+    with open(local_file, "r+b") as fh:
+        fh.truncate(50000)
+    with open(local_file + ".ckpnt", "wb") as fh:
+        pickle.dump(50000, fh)
+
+def test_mirror_resume(remote_directory, tmp_path):
+    remote_path, url = remote_directory
+    local_directory = str(tmp_path / "local")
+    mirror_directory(url, local_directory)
+
+    # Same remote version, carries on from the checkpoint
+    interrupt_download(local_directory)
+    RangeHandler.ranges = []
+    results = mirror_directory(url, local_directory)
+    assert results["a.bin"] == "downloaded"
+    assert [result for path, result in results.items() if path != "a.bin"] == ["skipped"] * 3
+    assert [byte_range for path, byte_range in RangeHandler.ranges if path == "/a.bin"] == ["bytes=50000-"]
+    assert read_local(local_directory, "a.bin") == remote_files["a.bin"]
+    assert not os.path.exists(os.path.join(local_directory, "a.bin.ckpnt"))
+
+    # Remote changed since, the partial download is thrown away
+    interrupt_download(local_directory)
+    new_data = os.urandom(120000)
+    (remote_path / "a.bin").write_bytes(new_data)
+    os.utime(remote_path / "a.bin", (time.time() + 10, time.time() + 10))
+    RangeHandler.ranges = []
+    results = mirror_directory(url, local_directory)
+    assert results["a.bin"] == "downloaded"
+    assert [byte_range for path, byte_range in RangeHandler.ranges if path == "/a.bin"] == ["bytes=0-"]
+    assert read_local(local_directory, "a.bin") == new_data
+
+def test_mirror_non_recursive(remote_directory, tmp_path):
+    remote_path, url = remote_directory
+    local_directory = str(tmp_path / "local")
+
+    results = mirror_directory(url, local_directory, recursive=False)
+    assert sorted(results) == ["a.bin", "b.bin"]
+    assert not os.path.exists(os.path.join(local_directory, "nested"))
+
+def test_mirror_manifest(remote_directory, tmp_path):
+    remote_path, url = remote_directory
+    local_directory = str(tmp_path / "local")
+
+    manifest = tmp_path / "manifest.jsonl"
+    with open(manifest, "w") as fh:
+        fh.write("a.bin\n")
+        fh.write(json.dumps({"path": "nested/c.bin",
+                             "checksum": hashlib.sha256(remote_files["nested/c.bin"]).hexdigest()}) + "\n")
+        fh.write(json.dumps({"path": "../escape.bin"}) + "\n")
+
+    results = mirror_directory(url, local_directory, manifest=str(manifest))
+    assert results == {"a.bin": "downloaded", "nested/c.bin": "downloaded"}
+    assert read_local(local_directory, "nested/c.bin") == remote_files["nested/c.bin"]
+
+    # Locally corrupted file fails the checksum comparison and is fetched again
+    with open(os.path.join(local_directory, "nested/c.bin"), "r+b") as fh:
+        fh.write(b"corrupt")
+    results = mirror_directory(url, local_directory, manifest=str(manifest))
+    assert results == {"a.bin": "skipped", "nested/c.bin": "downloaded"}
+    assert read_local(local_directory, "nested/c.bin") == remote_files["nested/c.bin"]
+
+def test_mirror_manifest_quoted(remote_directory, tmp_path):
+    # Manifest paths are plain file names, not url paths
+    remote_path, url = remote_directory
+    local_directory = str(tmp_path / "local")
+    data = os.urandom(1000)
+    (remote_path / "odd name #1?.bin").write_bytes(data)
+
+    manifest = tmp_path / "manifest.jsonl"
+    manifest.write_text("odd name #1?.bin\n")
+    results = mirror_directory(url, local_directory, manifest=str(manifest))
+    assert results == {"odd name #1?.bin": "downloaded"}
+    assert read_local(local_directory, "odd name #1?.bin") == data
@@ -0,0 +1,105 @@
+from best_download import Prefetcher
+from benchmarks.faulty_server import get_data
+import os
+import time
+import uuid
+import hashlib
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+size = 100000
+
+def get_shards(server, count, query=""):
+    return [{"url": f"{server.url}/data/{size}?run={uuid.uuid4().hex}&{query}", "local_file": f"shard_{i}.bin",
+             "checksum": hashlib.sha256(get_data(size)).hexdigest()}
+            for i in range(count)]
+
+def files_on_disk(directory):
+    return [name for name in os.listdir(directory) if name.endswith(".bin")]
+
+# ================ Tests ================ #
+def test_prefetch_in_order(faulty_server, tmp_path):
+    shards = get_shards(faulty_server, 10)
+    handed_out = []
+    with Prefetcher(shards, str(tmp_path), max_ahead=3, auto_tune=False) as prefetcher:
+        for local_file in prefetcher:
+            handed_out.append(os.path.basename(local_file))
+            assert os.path.getsize(local_file) == size
+            time.sleep(0.05) # Downloads catch up while the consumer works
+            # The shard being consumed plus at most 3 ahead
+            assert len(files_on_disk(tmp_path)) <= 4
+    assert handed_out == [f"shard_{i}.bin" for i in range(10)]
+    assert files_on_disk(tmp_path) == []
+
+def test_prefetch_byte_limits(faulty_server, tmp_path):
+    shards = get_shards(faulty_server, 8)
+    with Prefetcher(shards, str(tmp_path), max_ahead=None, disk_budget=3 * size) as prefetcher:
+        for local_file in prefetcher:
+            time.sleep(0.05)
+            assert len(files_on_disk(tmp_path)) <= 3
+
+    # Sizes found with a HEAD request when the shard dicts don't say
+    shards = get_shards(faulty_server, 6)
+    with Prefetcher(shards, str(tmp_path), max_ahead=None, max_bytes_ahead=2 * size) as prefetcher:
+        for local_file in prefetcher:
+            time.sleep(0.05)
+            assert len(files_on_disk(tmp_path)) <= 3
+
+    # Kept when not evicting
+    shards = get_shards(faulty_server, 3)
+    with Prefetcher(shards, str(tmp_path), evict=False) as prefetcher:
+        assert len(list(prefetcher)) == 3
+    assert len(files_on_disk(tmp_path)) == 3
+
+def test_prefetch_no_head(faulty_server, tmp_path):
+    # Without byte limits sizes aren't needed, use_head=False means GETs only
+    shards = get_shards(faulty_server, 6)
+    with Prefetcher(shards, str(tmp_path), use_head=False) as prefetcher:
+        assert len(list(prefetcher)) == 6
+    assert faulty_server.methods() == ["GET"] * 6
+
+def test_prefetch_auto_tune(faulty_server, tmp_path):
+    # Slow downloads and a fast consumer, depth grows to the limit
+    shards = get_shards(faulty_server, 12, "latency=0.2")
+    with Prefetcher(shards, str(tmp_path), max_ahead=6, max_workers=6) as prefetcher:
+        for local_file in prefetcher:
+            time.sleep(0.01)
+        assert prefetcher.depth == 6
+
+    # Fast downloads and a slow consumer, shallow prefetch is enough
+    shards = get_shards(faulty_server, 6)
+    with Prefetcher(shards, str(tmp_path), max_ahead=6, max_workers=6) as prefetcher:
+        for local_file in prefetcher:
+            time.sleep(0.2)
+        assert prefetcher.depth <= 2
+
+def test_prefetch_failure(faulty_server, tmp_path):
+    shards = get_shards(faulty_server, 3)
+    shards[1]["checksum"] = hashlib.sha256(b"other").hexdigest()
+    with Prefetcher(shards, str(tmp_path), max_retries=1) as prefetcher:
+        assert os.path.basename(next(prefetcher)) == "shard_0.bin"
+        with pytest.raises(RuntimeError):
+            next(prefetcher)
+
+    # Stopping early cleans up prefetched shards
+    shards = get_shards(faulty_server, 5)
+    prefetcher = Prefetcher(shards, str(tmp_path), max_ahead=4, auto_tune=False)
+    next(prefetcher)
+    prefetcher.close()
+    assert files_on_disk(tmp_path) == []
+
+def test_prefetch_close_interrupts(faulty_server, tmp_path):
+    # Running downloads stop within a chunk and keep their checkpoints
+    shards = get_shards(faulty_server, 1)
+    shards.append(f"{faulty_server.url}/data/10000000?bandwidth=2000000&run={uuid.uuid4().hex}")
+    prefetcher = Prefetcher(shards, str(tmp_path), auto_tune=False)
+    next(prefetcher)
+    time.sleep(1)
+    start = time.perf_counter()
+    prefetcher.close()
+    assert time.perf_counter() - start < 2
+    assert os.path.exists(tmp_path / "10000000.ckpnt")
+    assert os.path.getsize(tmp_path / "10000000") < 10000000
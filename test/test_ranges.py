@@ -0,0 +1,95 @@
+from best_download import fetch_ranges
+from best_download.ranges import MultipartReader
+from benchmarks.faulty_server import get_data
+import uuid
+import pytest
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+size = 5*1024*1024
+
+def data_url(server, query=""):
+    return f"{server.url}/data/{size}?run={uuid.uuid4().hex}&{query}"
+
+data = bytes(get_data(size))
+
+# Footer sized reads scattered over the file plus a pair close enough to coalesce
+ranges = [(i * 300000 + 17, 4096) for i in range(15)] + [(size - 100, 100), (size - 300, 150)]
+
+# ================ Tests ================ #
+def test_multipart_reader():
+    parts = []
+    body = (b"\r\n--xyz\r\nContent-Type: text/plain\r\nContent-Range: bytes 0-4/20\r\n\r\nhello"
+            b"\r\n--xyz\r\nContent-range: bytes 10-12/20\r\n\r\nabc\r\n--xyz--\r\n")
+    reader = MultipartReader("xyz", lambda position, data: parts.append((position, bytes(data))))
+    for i in range(len(body)): # Worst case, one byte at a time
+        reader.feed(body[i:i + 1])
+    assert reader.finished
+    assert b"".join(data for _, data in parts[:5]) == b"hello"
+    assert parts[0][0] == 0 and parts[5][0] == 10
+    assert b"".join(data for _, data in parts[5:]) == b"abc"
+
+    with pytest.raises(ValueError):
+        MultipartReader("xyz", None).feed(b"--xyz\r\nContent-Type: text/plain\r\n\r\nhello")
+
+def test_fetch_ranges(faulty_server):
+    buffers = fetch_ranges(data_url(faulty_server), ranges, max_gap=1024)
+    for (start, length), buffer in zip(ranges, buffers):
+        assert buffer == data[start:start + length]
+    # All coalesced into one multi-range request, the two footer reads share a span
+    assert len(faulty_server.ranges()) == 1
+    assert faulty_server.ranges()[0].count(",") == len(ranges) - 2
+
+    # Caller supplied buffers
+    destinations = [bytearray(length + 10) for _, length in ranges]
+    assert fetch_ranges(data_url(faulty_server), ranges, destinations=destinations) is destinations
+    assert destinations[3][:4096] == data[ranges[3][0]:ranges[3][0] + 4096]
+
+    with pytest.raises(ValueError):
+        fetch_ranges(data_url(faulty_server), [(0, 10)], destinations=[bytearray(5)])
+
+def test_fetch_ranges_fallback(faulty_server):
+    # Server only honours the first range, the rest go out as single ranges
+    buffers = fetch_ranges(data_url(faulty_server, "multiranges=0"), ranges, max_gap=1024)
+    for (start, length), buffer in zip(ranges, buffers):
+        assert buffer == data[start:start + length]
+    assert len(faulty_server.ranges()) == 1 + len(ranges) - 2
+    assert all("," not in header for header in faulty_server.ranges()[1:])
+
+    # No range support at all, every group picked out of the same full body
+    url = data_url(faulty_server, "ranges=0")
+    buffers = fetch_ranges(url, ranges, max_ranges=4)
+    for (start, length), buffer in zip(ranges, buffers):
+        assert buffer == data[start:start + length]
+    assert len(faulty_server.ranges(url[url.index("/data/"):])) == 1
+    url = data_url(faulty_server, "ranges=0&disconnects=1")
+    buffers = fetch_ranges(url, ranges, max_ranges=4)
+    assert buffers[-1] == data[ranges[-1][0]:ranges[-1][0] + ranges[-1][1]]
+    assert len(faulty_server.ranges(url[url.index("/data/"):])) == 2
+
+    # Retried after a disconnect half way through the multipart body
+    buffers = fetch_ranges(data_url(faulty_server, "disconnects=1"), ranges, max_ranges=4)
+    for (start, length), buffer in zip(ranges, buffers):
+        assert buffer == data[start:start + length]
+
+    assert fetch_ranges(f"{faulty_server.url}/missing", ranges, max_retries=1) is None
+
+def test_fetch_ranges_repair(faulty_server, tmp_path):
+    # Repair scattered bad blocks in place
+    local_file = tmp_path / "data.bin"
+    damaged = bytearray(data)
+    bad_blocks = [(4096 * i * 37, 4096) for i in range(1, 30)]
+    for start, length in bad_blocks:
+        damaged[start:start + length] = b"\0" * length
+    local_file.write_bytes(damaged)
+
+    assert fetch_ranges(data_url(faulty_server), bad_blocks, local_file=str(local_file))
+    assert local_file.read_bytes() == data
+
+    # Explicit offsets pack the ranges together
+    packed_file = tmp_path / "packed.bin"
+    offsets = [i * 4096 for i in range(len(bad_blocks))]
+    fetch_ranges(data_url(faulty_server), bad_blocks, local_file=str(packed_file), destinations=offsets)
+    assert packed_file.read_bytes() == b"".join(data[start:start + length] for start, length in bad_blocks)
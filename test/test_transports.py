@@ -0,0 +1,95 @@
+import best_download
+from best_download import download_file, download_bytes, fetch_ranges, set_transport
+from benchmarks.faulty_server import get_data
+import os
+import uuid
+import pickle
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("h2")
+from benchmarks.h2_server import DualProtocolServer, DualProtocolHandler
+
+import logging
+logger = logging.getLogger(__name__)
+
+# ================ SUPPORT ================ #
+size = 2*1024*1024 + 3
+
+@pytest.fixture(scope="module")
+def server():
+    server = DualProtocolServer(("localhost", 0), DualProtocolHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://localhost:{server.server_address[1]}"
+    server.shutdown()
+    server.server_close()
+
+# Every test talks HTTP/2, back to the default afterwards
+@pytest.fixture(autouse=True)
+def http2():
+    set_transport("http2", prior_knowledge=True, backoff_factor=0.1)
+    yield
+    set_transport("http1")
+
+def data_url(server, query=""):
+    return f"{server}/data/{size}?run={uuid.uuid4().hex}&{query}"
+
+expected = bytes(get_data(size))
+expected_checksum = hashlib.sha256(expected).hexdigest()
+
+# ================ Tests ================ #
+def test_http2_negotiated(server):
+    with best_download.transport.get(data_url(server)) as response:
+        assert response.status_code == 200
+        assert response.response.http_version == "HTTP/2"
+
+@pytest.mark.parametrize("use_head,query", [(True, ""), (False, ""), (True, "ranges=0"), (False, "ranges=0")])
+def test_http2_download(server, tmp_path, use_head, query):
+    local_file = str(tmp_path / "data.bin")
+    assert download_file(data_url(server, query), expected_checksum=expected_checksum, local_file=local_file,
+                         use_head=use_head)
+    assert open(local_file, "rb").read() == expected
+
+def test_http2_resume(server, tmp_path):
+    local_file = str(tmp_path / "data.bin")
+    half = size // 2
+    with open(local_file, "wb") as fh:
+        fh.write(expected[:half])
+    with open(local_file + ".ckpnt", "wb") as fh:
+        pickle.dump(half, fh)
+    assert download_file(data_url(server), expected_checksum=expected_checksum, local_file=local_file)
+    assert open(local_file, "rb").read() == expected
+    assert not os.path.exists(local_file + ".ckpnt")
+
+def test_http2_checksum_and_failover(server, tmp_path):
+    local_file = str(tmp_path / "data.bin")
+    assert not download_file(data_url(server), expected_checksum=hashlib.sha256(b"").hexdigest(),
+                             local_file=local_file, max_retries=1)
+
+    urls = [f"{server}/missing", data_url(server)]
+    assert download_file(urls, expected_checksum=expected_checksum, local_file=local_file, max_retries=1)
+
+def test_http2_buffer_and_ranges(server):
+    assert download_bytes(data_url(server), expected_checksum=expected_checksum) == expected
+
+    ranges = [(i * 100003, 1000) for i in range(20)]
+    buffers = fetch_ranges(data_url(server), ranges)
+    assert [bytes(buffer) for buffer in buffers] == [expected[start:start + length] for start, length in ranges]
+
+def test_http2_fallback_to_http1(server, tmp_path):
+    # No prior knowledge over plain http is HTTP/1.1, a request waits for the only
+    # connection longer than the 5s request timeout without failing
+    set_transport("http2", max_connections=1, retries=0)
+    url = f"{server}/data/1000000?latency=3&bandwidth=400000&run={uuid.uuid4().hex}"
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        results = list(executor.map(lambda i: download_file(url, local_file=str(tmp_path / f"data{i}.bin"),
+                                                            max_retries=1, use_head=False), range(2)))
+    assert all(results)
+
+def test_http1_on_same_server(server):
+    set_transport("http1")
+    assert download_bytes(data_url(server), expected_checksum=expected_checksum) == expected